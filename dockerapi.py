@@ -0,0 +1,686 @@
+import codecs
+import json
+import socket
+import ssl
+from collections import deque
+
+try:
+    from urllib.parse import quote, urlencode, urlparse
+except ImportError:
+    from urllib import quote, urlencode
+    from urlparse import urlparse
+
+from docker.utils import parse_host
+from tornado import gen
+from tornado import ioloop
+from tornado.httputil import HTTPHeaders, parse_response_start_line
+from tornado.iostream import IOStream, SSLIOStream, StreamClosedError
+from tornado.locks import Semaphore
+
+# Largest piece of a streamed body handed back at once.
+CHUNK_SIZE = 64 * 1024
+# Upper bound on the size of a response's status line and headers.
+MAX_HEADER_SIZE = 64 * 1024
+
+_json_decoder = json.JSONDecoder()
+
+
+class DockerError(Exception):
+    '''Base class for failed calls to the Docker daemon.'''
+
+
+class DockerConnectionError(DockerError):
+    '''The daemon could not be reached, dropped the connection, or did not answer in time.'''
+
+
+class DockerAPIError(DockerError):
+    '''The daemon answered a call with an error status.'''
+
+    def __init__(self, status_code, explanation):
+        super(DockerAPIError, self).__init__(
+            "{} Docker API error: {}".format(status_code, explanation))
+        self.status_code = status_code
+        self.explanation = explanation
+
+
+def tls_context(tls):
+    '''Build an SSLContext from a docker-py TLSConfig, as returned by kwargs_from_env.'''
+
+    context = ssl.SSLContext(tls.ssl_version or ssl.PROTOCOL_SSLv23)
+    if tls.verify:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.check_hostname = tls.assert_hostname is not False
+        if tls.ca_cert:
+            context.load_verify_locations(tls.ca_cert)
+        else:
+            context.load_default_certs()
+    if tls.cert:
+        context.load_cert_chain(*tls.cert)
+    return context
+
+
+class _Deadline(object):
+    '''Close a connection if a call on it runs past its timeout.'''
+
+    def __init__(self, stream, timeout):
+        self.expired = False
+        self._stream = stream
+        self._handle = None
+        if timeout is not None:
+            self._handle = ioloop.IOLoop.current().call_later(timeout, self._expire)
+
+    def _expire(self):
+        self.expired = True
+        self._stream.close()
+
+    def cancel(self):
+        if self._handle is not None:
+            ioloop.IOLoop.current().remove_timeout(self._handle)
+            self._handle = None
+
+
+class DockerStream(object):
+    '''The body of a Docker API response, read as it arrives.
+
+    The connection is returned to its client once the body has been read to the end, or dropped
+    if the stream is closed before that.'''
+
+    def __init__(self, client, stream, code, headers, method):
+        self.code = code
+        self.headers = headers
+        self._client = client
+        self._stream = stream
+        self._text = ''
+        self._decoder = None
+        self._remaining = None
+        self._chunked = False
+        self._done = False
+        self._released = False
+        self._keep_alive = headers.get('Connection', '').lower() != 'close'
+
+        if method == 'HEAD' or code in (204, 304) or 100 <= code < 200:
+            self._finish()
+        elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            self._chunked = True
+        elif 'Content-Length' in headers:
+            self._remaining = int(headers['Content-Length'])
+            if not self._remaining:
+                self._finish()
+        else:
+            # Delimited by the daemon closing the connection.
+            self._keep_alive = False
+
+    @property
+    def done(self):
+        return self._done
+
+    @gen.coroutine
+    def read_chunk(self):
+        '''Read the next piece of the body, or None once it has all been read.'''
+
+        if self._done:
+            raise gen.Return(None)
+        try:
+            if self._chunked:
+                data = yield self._read_chunked()
+            elif self._remaining is not None:
+                data = yield self._stream.read_bytes(min(self._remaining, CHUNK_SIZE),
+                                                     partial=True)
+                self._remaining -= len(data)
+                if not self._remaining:
+                    self._finish()
+            else:
+                try:
+                    data = yield self._stream.read_bytes(CHUNK_SIZE, partial=True)
+                except StreamClosedError:
+                    self._finish()
+                    data = None
+        except (StreamClosedError, socket.error, ssl.SSLError) as e:
+            self.close()
+            raise DockerConnectionError("Lost connection to the Docker daemon: {}".format(e))
+        raise gen.Return(data)
+
+    @gen.coroutine
+    def _read_chunked(self):
+        line = yield self._stream.read_until(b"\r\n", max_bytes=MAX_HEADER_SIZE)
+        size = int(line.split(b';', 1)[0].strip(), 16)
+        if size == 0:
+            # Skip any trailers up to the blank line that ends the message.
+            while line != b"\r\n":
+                line = yield self._stream.read_until(b"\r\n", max_bytes=MAX_HEADER_SIZE)
+            self._finish()
+            raise gen.Return(None)
+        data = yield self._stream.read_bytes(size + 2)
+        raise gen.Return(data[:-2])
+
+    @gen.coroutine
+    def read_all(self):
+        '''Read the rest of the body and return it.'''
+
+        parts = []
+        while True:
+            data = yield self.read_chunk()
+            if data is None:
+                break
+            parts.append(data)
+        raise gen.Return(b''.join(parts))
+
+    @gen.coroutine
+    def read_json(self):
+        '''Read the next document from a body made up of a sequence of JSON documents, like the
+        event stream. Returns None at the end of the body.'''
+
+        if self._decoder is None:
+            self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            self._text = self._text.lstrip()
+            if self._text:
+                try:
+                    document, end = _json_decoder.raw_decode(self._text)
+                except ValueError:
+                    # Not all of the document has arrived yet.
+                    pass
+                else:
+                    self._text = self._text[end:]
+                    raise gen.Return(document)
+            data = yield self.read_chunk()
+            if data is None:
+                raise gen.Return(None)
+            self._text += self._decoder.decode(data)
+
+    def close(self):
+        '''Stop reading, dropping the connection if the body has not been read to the end.'''
+
+        if not self._done:
+            self._keep_alive = False
+            self._stream.close()
+            self._finish()
+
+    def _finish(self):
+        self._done = True
+        if not self._released:
+            self._released = True
+            self._client._release(self._stream if self._keep_alive else None)
+
+
+class DockerEngineClient(object):
+    '''A non-blocking client for the Docker Engine API.
+
+    Calls are made on the IOLoop over the daemon's unix socket, or TCP (optionally with TLS), and
+    connections are kept alive and reused between calls. At most `max_connections` calls are in
+    flight at once; the rest wait for a connection to free up. Every call takes a
+    `request_timeout`, defaulting to `timeout`, covering the whole call for regular endpoints and
+    the wait for the response headers for streamed ones.'''
+
+    def __init__(self,
+                 base_url='unix://var/run/docker.sock',
+                 version='auto',
+                 timeout=30,
+                 max_connections=64,
+                 tls=None,
+                 ):
+        url = parse_host(base_url, False, tls=bool(tls))
+        if url.startswith('http+unix://'):
+            self._unix_path = '/' + url[len('http+unix://'):].lstrip('/')
+            self._address = None
+            self._host = 'docker'
+        else:
+            parsed = urlparse(url)
+            self._unix_path = None
+            self._address = (parsed.hostname, parsed.port)
+            self._host = parsed.netloc
+        self._ssl_context = tls_context(tls) if tls else None
+
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._version = None if version == 'auto' else version
+        self._version_future = None
+
+        self._slots = Semaphore(max_connections)
+        self._idle = deque()
+        self.active = 0
+
+    @gen.coroutine
+    def api_version(self):
+        '''The API version calls are made with, asking the daemon for it the first time if it was
+        configured as 'auto'.'''
+
+        if self._version is None:
+            if self._version_future is None:
+                self._version_future = self._get_json('/version', versioned=False)
+            try:
+                info = yield self._version_future
+            except Exception:
+                self._version_future = None
+                raise
+            self._version = info['ApiVersion']
+        raise gen.Return(self._version)
+
+    @gen.coroutine
+    def request(self, method, path, params=None, body=None, request_timeout=None,
+                versioned=True, headers=None):
+        '''Make a call and return the (code, headers, body) of its response. An error status is
+        raised as a DockerAPIError.'''
+
+        loop = ioloop.IOLoop.current()
+        timeout = self.timeout if request_timeout is None else request_timeout
+        started = loop.time()
+        response = yield self.stream(method, path, params=params, body=body,
+                                     request_timeout=timeout, versioned=versioned,
+                                     headers=headers)
+        remaining = None if timeout is None else max(0, timeout - (loop.time() - started))
+        deadline = _Deadline(response._stream, remaining)
+        try:
+            content = yield response.read_all()
+        except DockerConnectionError:
+            if deadline.expired:
+                raise DockerConnectionError(
+                    "Docker API call {} {} timed out after {}s".format(method, path, timeout))
+            raise
+        finally:
+            deadline.cancel()
+        raise gen.Return((response.code, response.headers, content))
+
+    @gen.coroutine
+    def stream(self, method, path, params=None, body=None, request_timeout=None,
+               versioned=True, headers=None):
+        '''Make a call and return a DockerStream of its body once the response headers arrive.
+
+        An error status is raised as a DockerAPIError, with the body already read.'''
+
+        timeout = self.timeout if request_timeout is None else request_timeout
+        url = yield self._url(path, params, versioned)
+        request = self._render(method, url, body, headers)
+
+        yield self._slots.acquire()
+        self.active += 1
+        try:
+            response = yield self._exchange(method, url, request, timeout)
+        except Exception:
+            self._release(None)
+            raise
+
+        if response.code >= 400:
+            try:
+                content = yield response.read_all()
+            finally:
+                response.close()
+            raise DockerAPIError(response.code, self._explain(content))
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def _exchange(self, method, url, request, timeout):
+        '''Send a rendered request and read the response headers, on a kept-alive connection if
+        one is idle.'''
+
+        while True:
+            stream, reused = self._idle_stream()
+            if stream is None:
+                stream = self._new_stream()
+            deadline = _Deadline(stream, timeout)
+            try:
+                if not reused:
+                    yield self._connect(stream)
+                stream.write(request)
+                head = yield stream.read_until_regex(b"\r?\n\r?\n", max_bytes=MAX_HEADER_SIZE)
+            except (StreamClosedError, socket.error, ssl.SSLError) as e:
+                stream.close()
+                if deadline.expired:
+                    raise DockerConnectionError(
+                        "Docker API call {} timed out after {}s".format(url, timeout))
+                if reused:
+                    # The daemon closed the idle connection; try again on a fresh one.
+                    continue
+                raise DockerConnectionError("Unable to reach the Docker daemon: {}".format(e))
+            finally:
+                deadline.cancel()
+            break
+
+        lines = head.decode('latin1').lstrip('\r\n')
+        start_line, _, header_lines = lines.partition('\n')
+        start_line = parse_response_start_line(start_line.rstrip('\r'))
+        response_headers = HTTPHeaders.parse(header_lines)
+        raise gen.Return(DockerStream(self, stream, start_line.code, response_headers, method))
+
+    def _idle_stream(self):
+        while self._idle:
+            stream = self._idle.pop()
+            if not stream.closed():
+                return stream, True
+        return None, False
+
+    def _new_stream(self):
+        if self._unix_path is not None:
+            return IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self._ssl_context is not None:
+            return SSLIOStream(sock, ssl_options=self._ssl_context)
+        return IOStream(sock)
+
+    def _connect(self, stream):
+        if self._unix_path is not None:
+            return stream.connect(self._unix_path)
+        if self._ssl_context is not None:
+            return stream.connect(self._address, server_hostname=self._address[0])
+        return stream.connect(self._address)
+
+    def _release(self, stream):
+        '''Give back a call's connection slot, keeping its connection for reuse if it can be.'''
+
+        if stream is not None and not stream.closed():
+            self._idle.append(stream)
+        self.active -= 1
+        self._slots.release()
+
+    @gen.coroutine
+    def _url(self, path, params, versioned):
+        if versioned:
+            version = yield self.api_version()
+            path = '/v{}{}'.format(version, path)
+        if params:
+            query = []
+            for key, value in sorted(params.items()):
+                if value is None:
+                    continue
+                if isinstance(value, bool):
+                    value = int(value)
+                elif isinstance(value, (dict, list)):
+                    value = json.dumps(value)
+                query.append((key, value))
+            if query:
+                path = '{}?{}'.format(path, urlencode(query))
+        raise gen.Return(path)
+
+    def _render(self, method, url, body, headers):
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            content_type = 'application/x-tar'
+        lines = ['{} {} HTTP/1.1'.format(method, url),
+                 'Host: {}'.format(self._host),
+                 'User-Agent: tmpnb']
+        if body is not None:
+            lines.append('Content-Type: {}'.format(content_type))
+            lines.append('Content-Length: {}'.format(len(body)))
+        elif method in ('POST', 'PUT'):
+            lines.append('Content-Length: 0')
+        for name, value in (headers or {}).items():
+            lines.append('{}: {}'.format(name, value))
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin1')
+        return head + (body or b'')
+
+    def _explain(self, content):
+        text = content.decode('utf-8', 'replace').strip()
+        try:
+            return json.loads(text)['message']
+        except (ValueError, KeyError, TypeError):
+            return text
+
+    @gen.coroutine
+    def _get_json(self, path, params=None, request_timeout=None, versioned=True):
+        code, headers, content = yield self.request('GET', path, params=params,
+                                                    request_timeout=request_timeout,
+                                                    versioned=versioned)
+        raise gen.Return(json.loads(content.decode('utf-8')))
+
+    @gen.coroutine
+    def _post_json(self, path, params=None, body=None, request_timeout=None):
+        code, headers, content = yield self.request('POST', path, params=params, body=body,
+                                                    request_timeout=request_timeout)
+        raise gen.Return(json.loads(content.decode('utf-8')) if content.strip() else None)
+
+    def _container_path(self, container, suffix=''):
+        return '/containers/{}{}'.format(quote(container, safe=''), suffix)
+
+    # Containers
+
+    @gen.coroutine
+    def containers(self, all=False, filters=None, request_timeout=None):
+        '''List containers, as `docker ps` does. `filters` is a dict of filter names to lists of
+        values.'''
+
+        params = {'all': all}
+        if filters:
+            params['filters'] = filters
+        result = yield self._get_json('/containers/json', params, request_timeout)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def inspect_container(self, container, request_timeout=None):
+        result = yield self._get_json(self._container_path(container, '/json'),
+                                      request_timeout=request_timeout)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def port(self, container, private_port, request_timeout=None):
+        '''The host bindings of a container's `private_port`, as `docker port` reports them.'''
+
+        info = yield self.inspect_container(container, request_timeout=request_timeout)
+        ports = info.get('NetworkSettings', {}).get('Ports')
+        if ports is None:
+            raise gen.Return(None)
+        private_port = str(private_port)
+        if '/' in private_port:
+            raise gen.Return(ports.get(private_port))
+        bindings = ports.get(private_port + '/tcp')
+        if bindings is None:
+            bindings = ports.get(private_port + '/udp')
+        raise gen.Return(bindings)
+
+    @gen.coroutine
+    def create_container(self, config, name=None, request_timeout=None):
+        '''Create a container from an Engine API container config, such as a
+        docker.types.ContainerConfig. Returns the daemon's response, with the new 'Id'.'''
+
+        result = yield self._post_json('/containers/create', {'name': name}, config,
+                                       request_timeout)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def start(self, container, request_timeout=None):
+        yield self.request('POST', self._container_path(container, '/start'),
+                           request_timeout=request_timeout)
+
+    @gen.coroutine
+    def stop(self, container, timeout=10, request_timeout=None):
+        '''Stop a container, killing it if it has not exited `timeout` seconds after being
+        signalled. The call is allowed that much longer to finish.'''
+
+        if request_timeout is None:
+            request_timeout = timeout + (self.timeout or 0)
+        yield self.request('POST', self._container_path(container, '/stop'), {'t': timeout},
+                           request_timeout=request_timeout)
+
+    @gen.coroutine
+    def kill(self, container, signal=None, request_timeout=None):
+        yield self.request('POST', self._container_path(container, '/kill'), {'signal': signal},
+                           request_timeout=request_timeout)
+
+    @gen.coroutine
+    def remove_container(self, container, v=False, force=False, request_timeout=None):
+        yield self.request('DELETE', self._container_path(container), {'v': v, 'force': force},
+                           request_timeout=request_timeout)
+
+    @gen.coroutine
+    def pause(self, container, request_timeout=None):
+        yield self.request('POST', self._container_path(container, '/pause'),
+                           request_timeout=request_timeout)
+
+    @gen.coroutine
+    def unpause(self, container, request_timeout=None):
+        yield self.request('POST', self._container_path(container, '/unpause'),
+                           request_timeout=request_timeout)
+
+    @gen.coroutine
+    def update_container(self, container, mem_limit=None, memswap_limit=None,
+                         mem_reservation=None, cpu_quota=None, cpu_shares=None,
+                         cpuset_cpus=None, cpuset_mems=None, request_timeout=None):
+        '''Change the resource limits of a container. Limits left as None are not changed.'''
+
+        fields = {
+            'Memory': mem_limit,
+            'MemorySwap': memswap_limit,
+            'MemoryReservation': mem_reservation,
+            'CpuQuota': cpu_quota,
+            'CpuShares': cpu_shares,
+            'CpusetCpus': cpuset_cpus,
+            'CpusetMems': cpuset_mems,
+        }
+        body = dict((key, value) for key, value in fields.items() if value is not None)
+        result = yield self._post_json(self._container_path(container, '/update'), body=body,
+                                       request_timeout=request_timeout)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def logs(self, container, stdout=True, stderr=True, tail='all', follow=False,
+             timestamps=False, request_timeout=None):
+        '''Open a DockerStream of a container's logs. Unless the container has a TTY, the body is
+        multiplexed into frames, each with an 8 byte header naming its stream and length.'''
+
+        params = {'stdout': stdout, 'stderr': stderr, 'tail': tail, 'follow': follow,
+                  'timestamps': timestamps}
+        response = yield self.stream('GET', self._container_path(container, '/logs'), params,
+                                     request_timeout=request_timeout)
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def get_archive(self, container, path, request_timeout=None):
+        '''Open a DockerStream of a tar archive of `path` within a container.'''
+
+        response = yield self.stream('GET', self._container_path(container, '/archive'),
+                                     {'path': path}, request_timeout=request_timeout)
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def put_archive(self, container, path, data, request_timeout=None):
+        '''Extract the tar archive `data` into `path` within a container.'''
+
+        yield self.request('PUT', self._container_path(container, '/archive'), {'path': path},
+                           body=data, request_timeout=request_timeout)
+
+    # Execs
+
+    @gen.coroutine
+    def exec_create(self, container, cmd, user=None, request_timeout=None):
+        '''Set up `cmd` (a list) to run in a running container. Returns the exec's id.'''
+
+        body = {'Cmd': cmd, 'AttachStdout': True, 'AttachStderr': True}
+        if user:
+            body['User'] = user
+        result = yield self._post_json(self._container_path(container, '/exec'), body=body,
+                                       request_timeout=request_timeout)
+        raise gen.Return(result['Id'])
+
+    @gen.coroutine
+    def exec_start(self, exec_id, request_timeout=None):
+        '''Run an exec, returning a DockerStream of its output, multiplexed like a container's
+        logs. The stream ends when the command exits.'''
+
+        response = yield self.stream('POST', '/exec/{}/start'.format(quote(exec_id, safe='')),
+                                     body={'Detach': False, 'Tty': False},
+                                     request_timeout=request_timeout)
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def exec_inspect(self, exec_id, request_timeout=None):
+        result = yield self._get_json('/exec/{}/json'.format(quote(exec_id, safe='')),
+                                      request_timeout=request_timeout)
+        raise gen.Return(result)
+
+    # Images
+
+    @gen.coroutine
+    def inspect_image(self, image, request_timeout=None):
+        result = yield self._get_json('/images/{}/json'.format(quote(image, safe='/:@')),
+                                      request_timeout=request_timeout)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def inspect_distribution(self, image, request_timeout=None):
+        '''Ask the registry about an image reference without pulling it. The digest it currently
+        points to is in result['Descriptor']['digest'].'''
+
+        result = yield self._get_json(
+            '/distribution/{}/json'.format(quote(image, safe='/:@')),
+            request_timeout=request_timeout)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def pull(self, repository, tag=None, request_timeout=None):
+        '''Start pulling an image, returning a DockerStream of progress documents (read with
+        DockerStream.read_json). A failed pull reports an 'error' in its last document rather
+        than an error status. `tag` may be a digest.'''
+
+        response = yield self.stream('POST', '/images/create',
+                                     {'fromImage': repository, 'tag': tag},
+                                     request_timeout=request_timeout)
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def commit(self, container, repository=None, tag=None, comment=None, labels=None,
+               pause=True, request_timeout=None):
+        '''Create an image from a container, with `labels` added to its config. Returns the
+        new image's id.'''
+
+        params = {'container': container, 'repo': repository, 'tag': tag, 'comment': comment,
+                  'pause': pause}
+        body = {'Labels': labels} if labels else None
+        result = yield self._post_json('/commit', params, body, request_timeout)
+        raise gen.Return(result['Id'])
+
+    # Networks
+
+    @gen.coroutine
+    def networks(self, filters=None, request_timeout=None):
+        params = {}
+        if filters:
+            params['filters'] = filters
+        result = yield self._get_json('/networks', params, request_timeout)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def inspect_network(self, net_id, request_timeout=None):
+        result = yield self._get_json('/networks/{}'.format(quote(net_id, safe='')),
+                                      request_timeout=request_timeout)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def create_network(self, name, driver='bridge', internal=False, labels=None,
+                       options=None, request_timeout=None):
+        '''Create a network. Returns the daemon's response, with the new 'Id'.'''
+
+        body = {
+            'Name': name,
+            'Driver': driver,
+            'Internal': internal,
+            'Labels': labels or {},
+            'Options': options or {},
+            'CheckDuplicate': True,
+        }
+        result = yield self._post_json('/networks/create', body=body,
+                                       request_timeout=request_timeout)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def remove_network(self, net_id, request_timeout=None):
+        yield self.request('DELETE', '/networks/{}'.format(quote(net_id, safe='')),
+                           request_timeout=request_timeout)
+
+    @gen.coroutine
+    def connect_container_to_network(self, container, net_id, request_timeout=None):
+        yield self.request('POST', '/networks/{}/connect'.format(quote(net_id, safe='')),
+                           body={'Container': container}, request_timeout=request_timeout)
+
+    # System
+
+    @gen.coroutine
+    def events(self, since=None, filters=None, request_timeout=None):
+        '''Open a DockerStream of daemon events, read with DockerStream.read_json. Only waiting
+        for the stream to open is subject to the timeout.'''
+
+        params = {'since': since}
+        if filters:
+            params['filters'] = filters
+        response = yield self.stream('GET', '/events', params, request_timeout=request_timeout)
+        raise gen.Return(response)
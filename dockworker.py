@@ -1,18 +1,24 @@
 import binascii
-from collections import namedtuple
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque, namedtuple
+import glob
 import os
+import random
+import socket
+import struct
 
 import docker
-import requests
 import logging
-from docker.utils import kwargs_from_env 
+from docker.utils import kwargs_from_env, parse_bytes
 
 
 
 from tornado import gen
+from tornado import ioloop
+from tornado.concurrent import Future
 from tornado.log import app_log
 
+import dockerapi
+
 ContainerConfig = namedtuple('ContainerConfig', [
     'image', 'command', 'mem_limit', 'cpu_quota', 'cpu_shares', 'container_ip',
     'container_port', 'container_user', 'host_network', 'host_directories',
@@ -20,282 +26,1077 @@ ContainerConfig = namedtuple('ContainerConfig', [
 ])
 
 # Number of times to retry API calls before giving up.
-RETRIES = 1
+RETRIES = 3
+# Retries back off exponentially from BACKOFF_BASE seconds, up to BACKOFF_CAP, with full jitter.
+BACKOFF_BASE = 0.25
+BACKOFF_CAP = 8.0
+# Seconds a commit may take to write out a container's filesystem as an image.
+COMMIT_TIMEOUT = 600
 
+# Labels attached to every container so that pools can find their own containers with
+# server-side filters.
+POOL_LABEL = 'tmpnb.pool'
+PATH_LABEL = 'tmpnb.path'
+USER_LABEL = 'tmpnb.user'
+CREATED_LABEL = 'tmpnb.created'
+IMAGE_LABEL = 'tmpnb.image'
+# Label on the template containers a pool bakes warm images from, naming the pool.
+BAKE_LABEL = 'tmpnb.bake'
+# Labels on warm images, recording what they were baked from.
+WARM_SOURCE_LABEL = 'tmpnb.warm.source'
+WARM_SCRIPT_LABEL = 'tmpnb.warm.script'
 
-class AsyncDockerClient():
-    '''Completely ridiculous wrapper for a Docker client that returns futures
-    on every single docker method called on it, configured with an executor.
-    If no executor is passed, it defaults ThreadPoolExecutor(max_workers=2).
-    '''
-    def __init__(self, docker_client, executor=None):
-        if executor is None:
-            executor = ThreadPoolExecutor(max_workers=1)
-        self._docker_client = docker_client
-        self.executor = executor
 
-    def __getattr__(self, name):
-        '''Creates a function, based on docker_client.name that returns a
-        Future. If name is not a callable, returns the attribute directly.
-        '''
-        fn = getattr(self._docker_client, name)
+def label_filters(labels):
+    '''Build a Docker `filters` value matching containers that carry all of `labels`.'''
+    return {'label': ['{}={}'.format(key, value) for key, value in sorted(labels.items())]}
 
-        # Make sure it really is a function first
-        if not callable(fn):
-            return fn
 
-        def method(*args, **kwargs):
-            return self.executor.submit(fn, *args, **kwargs)
+def demultiplex(data):
+    '''Join the frames of a multiplexed log stream, each led by an 8 byte header whose last 4
+    bytes are its length, into text.'''
 
-        return method
+    chunks = []
+    offset = 0
+    while offset + 8 <= len(data):
+        length = struct.unpack('>I', data[offset + 4:offset + 8])[0]
+        chunks.append(data[offset + 8:offset + 8 + length])
+        offset += 8 + length
+    return b''.join(chunks).decode('utf-8', 'replace')
 
 
-class DockerSpawner():
-    def __init__(self,
-                 docker_host='unix://var/run/docker.sock',
-                 version='auto',
-                 timeout=30,
-                 max_workers=64,
-                 assert_hostname=False,
-                 ):
+# Classes of Docker operation. Each has its own concurrency budget and queue, so that a backlog
+# in one (say, tearing down hundreds of culled containers) can't hold up the others.
+LAUNCH = 'launch'       # creating and starting containers, and readying them for users
+INSPECT = 'inspect'     # listing and inspecting
+TEARDOWN = 'teardown'   # stopping and removing, and other background changes to idle containers
+BULK = 'bulk'           # copying files in and out
+OPERATION_CLASSES = (LAUNCH, INSPECT, TEARDOWN, BULK)
 
-        #kwargs = kwargs_from_env(assert_hostname=False)
-        kwargs = kwargs_from_env(assert_hostname=assert_hostname)
+# Default maximum number of concurrent calls allowed for each class of operation.
+CONCURRENCY = {
+    LAUNCH: 32,
+    INSPECT: 8,
+    TEARDOWN: 16,
+    BULK: 2,
+}
+
+# Call latency (s) above which each class of operation is taken to be overloading the daemon.
+# Stopping includes the container's grace period, and archives depend on their size.
+LATENCY_TARGETS = {
+    LAUNCH: 5.0,
+    INSPECT: 2.0,
+    TEARDOWN: 15.0,
+    BULK: 60.0,
+}
+
+# Factor the concurrency of a class is cut by when the daemon shows signs of overload.
+DECREASE = 0.5
+
+
+def backoff(attempt):
+    '''Seconds to wait before retry number `attempt` (from 0).'''
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
 
-        # environment variable DOCKER_HOST takes precedence
-        kwargs.setdefault('base_url', docker_host)
 
-        blocking_docker_client = docker.APIClient(version=version,
-                                               timeout=timeout,
-                                               **kwargs)
+def is_transient(error):
+    '''Whether a Docker error is a sign of trouble with the daemon rather than with the call: a
+    lost connection, a timeout or a server error.'''
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, dockerapi.DockerAPIError):
+        return error.status_code >= 500
+    return isinstance(error, dockerapi.DockerError)
+
+
+class CircuitOpenError(dockerapi.DockerError):
+    '''Raised instead of making a Docker call while the circuit breaker is open.'''
+
+
+class CircuitBreaker():
+    '''Stop calling the Docker daemon while it is failing, to give it room to recover.
+
+    The breaker opens once at least `failure_threshold` of the last `window` calls have failed
+    with transient errors or been slower than `slow_call` seconds. After `reset_timeout`
+    seconds a single probe call is let through: the breaker closes if it succeeds, and opens
+    again if not.'''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=0.5, window=20, min_calls=10, slow_call=10.0,
+                 reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.min_calls = min_calls
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened = 0
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def failure_rate(self):
+        if not self._outcomes:
+            return 0.0
+        return float(sum(self._outcomes)) / len(self._outcomes)
+
+    def allow(self):
+        '''Whether a call may be made now.'''
+
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if ioloop.IOLoop.current().time() - self._opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record(self, failed):
+        '''Record the outcome of a call that was allowed.'''
+
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+            if failed:
+                self._open()
+            else:
+                app_log.info("Docker daemon has recovered; closing the circuit breaker.")
+                self.state = self.CLOSED
+                self._outcomes.clear()
+            return
+        self._outcomes.append(bool(failed))
+        if (self.state == self.CLOSED and len(self._outcomes) >= self.min_calls and
+                self.failure_rate >= self.failure_threshold):
+            app_log.error("Docker daemon is failing (%.0f%% of recent calls); opening the "
+                          "circuit breaker for %ss.", 100 * self.failure_rate, self.reset_timeout)
+            self._open()
 
-        executor = ThreadPoolExecutor(max_workers=max_workers)
+    def _open(self):
+        self.state = self.OPEN
+        self.opened += 1
+        self._opened_at = ioloop.IOLoop.current().time()
 
-        async_docker_client = AsyncDockerClient(blocking_docker_client,
-                                                executor)
-        self.docker_client = async_docker_client
+    def stats(self):
+        return {
+            'state': self.state,
+            'failure_rate': self.failure_rate,
+            'opened': self.opened,
+        }
 
-        self.port = 0
+
+class Bulkhead():
+    '''Limit the number of concurrent calls of one class of operation, queueing the rest in
+    order and measuring how long they wait.
+
+    The limit adapts to the daemon, additive increase, multiplicative decrease: it grows by one
+    for every `limit` calls that finish within `target_latency`, and is cut by DECREASE (at most
+    once per `target_latency`) when a call is slower or fails with a transient error. It stays
+    between 1 and `max_limit`.'''
+
+    def __init__(self, name, max_limit, target_latency=None):
+        self.name = name
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        # Start low and let good latency open things up, rather than starting with a stampede.
+        self._limit = float(max(1, max_limit // 4))
+        self._decreased_at = None
+        self.active = 0
+        self._waiters = deque()
+        self.calls = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def queued(self):
+        return len(self._waiters)
 
     @gen.coroutine
-    def create_notebook_server(self, base_path, container_name, container_config):
-        '''Creates a notebook_server running off of `base_path`.
-
-        Returns the (container_id, ip, port) tuple in a Future.'''
-      
-        if container_config.host_network  or container_config.docker_network: 
-            # Start with specified container port
-            if self.port == 0:
-                self.port = int(container_config.container_port)
-            port = self.port
-            self.port += 1
-            # No bindings when using the host network or internal docker network
+    def run(self, fn, *args, **kwargs):
+        '''Call the coroutine function `fn` once a slot is free, and return its result.'''
+
+        loop = ioloop.IOLoop.current()
+        queued_at = loop.time()
+        if self.active >= self.limit or self._waiters:
+            waiter = Future()
+            self._waiters.append(waiter)
+            yield waiter
+        else:
+            self.active += 1
+        started = loop.time()
+        waited = started - queued_at
+        self.calls += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        try:
+            result = yield fn(*args, **kwargs)
+        except Exception as e:
+            self._adjust(loop.time() - started, is_transient(e))
+            raise
+        else:
+            self._adjust(loop.time() - started, False)
+        finally:
+            self._release()
+        raise gen.Return(result)
+
+    def _adjust(self, latency, failed):
+        now = ioloop.IOLoop.current().time()
+        if failed or (self.target_latency is not None and latency > self.target_latency):
+            cooldown = self.target_latency or 0
+            if self._decreased_at is None or now - self._decreased_at >= cooldown:
+                self._limit = max(1.0, self._limit * DECREASE)
+                self._decreased_at = now
+                app_log.warning("Docker %s calls are struggling (%.2fs); cutting concurrency "
+                                "to [%i].", self.name, latency, self.limit)
+        else:
+            self._limit = min(float(self.max_limit), self._limit + 1.0 / self._limit)
+
+    def _release(self):
+        # The slot passes straight to the next waiters, as far as the current limit allows.
+        self.active -= 1
+        while self._waiters and self.active < self.limit:
+            self.active += 1
+            self._waiters.popleft().set_result(None)
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'max_limit': self.max_limit,
+            'active': self.active,
+            'queued': self.queued,
+            'calls': self.calls,
+            'mean_wait': self.total_wait / self.calls if self.calls else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+# Number of ports handed out to containers when no port range is configured, starting from the
+# container port.
+DEFAULT_PORT_SPAN = 10000
+
+
+class NoPortAvailableError(Exception):
+    '''Every port in the allocator's range is in use.'''
+
+
+def port_in_use(ip, port):
+    '''Whether something on this host is already bound to `port` on `ip`.'''
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((ip, port))
+    except socket.error:
+        return True
+    finally:
+        sock.close()
+    return False
+
+
+class PortAllocator():
+    '''Hand out ports in [start, end] to containers that listen directly on a network, and take
+    them back once the containers are gone.
+
+    Ports are tracked in a bitmap and handed out round robin, so a returned port is reused as
+    late as possible. If `host_ip` is given, ports that something else on the host has already
+    bound are skipped.'''
+
+    def __init__(self, start, end, host_ip=None):
+        if not 0 < start <= end <= 65535:
+            raise ValueError("Invalid port range {}-{}".format(start, end))
+        self.start = start
+        self.end = end
+        self.host_ip = host_ip
+        self.in_use = 0
+        self._used = bytearray(end - start + 1)
+        self._next = 0
+
+    def __len__(self):
+        return len(self._used)
+
+    def reserve(self):
+        '''Reserve and return a free port.'''
+
+        size = len(self._used)
+        for offset in range(size):
+            index = (self._next + offset) % size
+            if self._used[index]:
+                continue
+            port = self.start + index
+            if self.host_ip is not None and port_in_use(self.host_ip, port):
+                continue
+            self._used[index] = 1
+            self.in_use += 1
+            self._next = (index + 1) % size
+            return port
+        raise NoPortAvailableError("No free ports in {}-{}".format(self.start, self.end))
+
+    def claim(self, port):
+        '''Mark a port that is already in use, such as one held by an adopted container, as
+        reserved.'''
+
+        index = port - self.start
+        if 0 <= index < len(self._used) and not self._used[index]:
+            self._used[index] = 1
+            self.in_use += 1
+
+    def release(self, port):
+        '''Return a reserved port.'''
+
+        index = port - self.start
+        if 0 <= index < len(self._used) and self._used[index]:
+            self._used[index] = 0
+            self.in_use -= 1
+
+    def stats(self):
+        return {
+            'start': self.start,
+            'end': self.end,
+            'in_use': self.in_use,
+        }
+
+
+def parse_cpulist(cpulist):
+    '''Parse a kernel CPU list such as "0-3,8-11" into a list of CPU numbers.'''
+
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def read_numa_topology(sys_path='/sys/devices/system/node'):
+    '''Map each NUMA node on this host to its CPUs, as read from sysfs. The map is empty where
+    sysfs does not list the nodes.'''
+
+    topology = {}
+    for path in glob.glob(os.path.join(sys_path, 'node[0-9]*')):
+        try:
+            with open(os.path.join(path, 'cpulist')) as f:
+                cpus = parse_cpulist(f.read())
+        except IOError:
+            continue
+        if cpus:
+            topology[int(os.path.basename(path)[len('node'):])] = cpus
+    return topology
+
+
+def read_package_topology(cpuinfo_path='/proc/cpuinfo'):
+    '''Map each physical package on this host to its CPUs according to /proc/cpuinfo, which
+    matches the NUMA nodes on most hosts. Package ids are not node ids, though.'''
+
+    topology = {}
+    processor = None
+    with open(cpuinfo_path) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            key = key.strip()
+            if key == 'processor':
+                processor = int(value)
+                topology.setdefault(0, []).append(processor)
+            elif key == 'physical id' and processor is not None:
+                topology[0].remove(processor)
+                topology.setdefault(int(value), []).append(processor)
+    return dict((node, cpus) for node, cpus in topology.items() if cpus)
+
+
+class CpusetAllocator():
+    '''Pin containers to slices of `size` CPUs within a single NUMA node, along with that node's
+    memory, balancing the slices by how many containers each CPU already has.
+
+    CPUs are shared once there are more containers than slices; a container is always placed on
+    the least loaded node, on its least loaded CPUs.
+
+    Without NUMA nodes in sysfs, CPUs are grouped by physical package instead. Memory is then left
+    unpinned, since a package id is not necessarily a memory node, and reserved slices carry None
+    for their node.'''
+
+    def __init__(self, size, topology=None):
+        self.numa = True
+        if topology is None:
+            topology = read_numa_topology()
+            if not topology:
+                self.numa = False
+                topology = read_package_topology()
+        self.topology = topology
+        largest = max(len(cpus) for cpus in self.topology.values())
+        if not 0 < size <= largest:
+            raise ValueError("A cpuset of {} CPUs does not fit on a node of this host "
+                             "(at most {}).".format(size, largest))
+        self.size = size
+        self._load = dict((cpu, 0) for cpus in self.topology.values() for cpu in cpus)
+
+    def reserve(self):
+        '''Reserve a slice, returned as (node, cpus).'''
+
+        def node_load(node):
+            cpus = self.topology[node]
+            return float(sum(self._load[cpu] for cpu in cpus)) / len(cpus)
+        candidates = [node for node, cpus in self.topology.items() if len(cpus) >= self.size]
+        node = min(sorted(candidates), key=node_load)
+        cpus = sorted(sorted(self.topology[node], key=lambda cpu: self._load[cpu])[:self.size])
+        for cpu in cpus:
+            self._load[cpu] += 1
+        return (node if self.numa else None), cpus
+
+    def claim(self, cpuset):
+        '''Count a slice that is already in use, such as one held by an adopted container.'''
+
+        node, cpus = cpuset
+        for cpu in cpus:
+            if cpu in self._load:
+                self._load[cpu] += 1
+
+    def release(self, cpuset):
+        '''Return a slice from reserve.'''
+
+        node, cpus = cpuset
+        for cpu in cpus:
+            self._load[cpu] = max(0, self._load[cpu] - 1)
+
+    def stats(self):
+        return dict((node, sum(self._load[cpu] for cpu in cpus))
+                    for node, cpus in self.topology.items())
+
+
+def parse_host_directories(host_directories):
+    '''Parse the host_directories option into the (volumes, binds) to create a container with.'''
+
+    volume_bindings = {}
+    volumes = []
+    if host_directories:
+        directories = host_directories.split(",")
+        for index, item in enumerate(directories):
+            directory = item.split(":")[0]
+            try:
+                mount_path = item.split(":")[1]
+                if not mount_path:  # /host/dir::ro
+                    raise IndexError
+            except IndexError:
+                mount_path = '/mnt/vol' + str(index)
+            try:
+                permissions = item.split(":")[2]
+                if not permissions:
+                    raise IndexError
+            except IndexError:
+                permissions = 'rw'
+
+            volumes.append(mount_path)
+            volume_bindings[directory] = {
+                'bind': mount_path,
+                'mode': permissions
+              }
+    return volumes, volume_bindings
+
+
+def template_key(container_config):
+    '''A hashable key for a ContainerConfig, whose extra_hosts may be a list.
+
+    Only whether there is a docker network counts, not which: the network is filled in for each
+    launch, so that containers spread over many networks share a template.'''
+    return tuple(tuple(field) if isinstance(field, list) else field
+                 for field in container_config._replace(
+                     docker_network=bool(container_config.docker_network)))
+
+
+class LaunchTemplate():
+    '''Everything about creating a container that follows from its ContainerConfig and the API
+    version, worked out once and shared by every launch with that config. Only the name, labels,
+    port, token and docker network differ from one container to the next.'''
+
+    def __init__(self, container_config, version):
+        self.version = version
+        # With the host network or a docker network, each container gets its own port and there
+        # are no bindings. Otherwise the container port is bound to a random host port.
+        self.fixed_port = bool(container_config.host_network or container_config.docker_network)
+        if self.fixed_port:
             port_bindings = None
         else:
-            # Bind the specified within-container port to a random port
-            # on the container-host IP address
-            port = container_config.container_port
             port_bindings = {
                 container_config.container_port: (container_config.container_ip,)
             }
- 
-
-        # Assumes that the container_config.command is of a format like:
-        #
-        #  ipython notebook --no-browser --port {port} --ip=0.0.0.0
-        #    --NotebookApp.base_path={base_path}
-        #    --NotebookApp.tornado_settings=\"{ \"template_path\": [ \"/srv/ga\",
-        #    \"/srv/ipython/IPython/html\",
-        #    \"/srv/ipython/IPython/html/templates\" ] }\""
-        #
-        # Important piece here is the parametrized base_path to let the
-        # underlying process know where the proxy is routing it.
-        if container_config.use_tokens:
-            # Generate token for authenticating first request (requires notebook 4.3)
-            # making each server semi-private for the user who is first assigned.
-            token = binascii.hexlify(os.urandom(24)).decode('ascii')
+
+        if container_config.host_network:
+            network_mode = 'host'
+            networking_config = None
+        elif container_config.docker_network:
+            # Set for each launch by container_body.
+            network_mode = None
+            networking_config = None
         else:
-            token = ''
-        rendered_command = container_config.command.format(base_path=base_path, port=port,
-            ip=container_config.container_ip, token=token)
-
-        command = [
-            "/bin/sh",
-            "-c",
-            rendered_command
-        ]
-
-        volume_bindings = {}
-        volumes = []
-        if container_config.host_directories:
-            directories = container_config.host_directories.split(",")
-            for index, item in enumerate(directories):
-                directory = item.split(":")[0]
-                try:
-                    mount_path = item.split(":")[1]
-                    if not mount_path:  # /host/dir::ro
-                        raise IndexError
-                except IndexError:
-                    mount_path = '/mnt/vol' + str(index)
-                try:
-                    permissions = item.split(":")[2]
-                    if not permissions:
-                        raise IndexError
-                except IndexError:
-                    permissions = 'rw'
-
-                volumes.append(mount_path)
-                volume_bindings[directory] = {
-                    'bind': mount_path,
-                    'mode': permissions
-                  }
+            network_mode = 'bridge'
+            networking_config = None
 
+        volumes, volume_bindings = parse_host_directories(container_config.host_directories)
         extra_hosts = dict(map(lambda h: tuple(h.split(':')),
-                               container_config.extra_hosts))
+                               container_config.extra_hosts or ()))
 
-        host_config = dict(
+        host_config = docker.types.HostConfig(
+            version=version,
             mem_limit=container_config.mem_limit,
-            network_mode='host' if container_config.host_network else 'bridge',
+            network_mode=network_mode,
             binds=volume_bindings,
             port_bindings=port_bindings,
             extra_hosts=extra_hosts,
             cpu_quota=container_config.cpu_quota,
-        ) 
-        
-        # host_config=client.create_host_config(port_bindings={8888: ('127.0.0.1', 80)})
-
-        host_config = docker.APIClient.create_host_config(self.docker_client,
-                                                       **host_config)
-        
-        app_log.info('host_config %s', host_config)
-        cpu_shares = None
+        )
 
+        cpu_shares = None
         if container_config.cpu_shares:
             # Some versions of Docker and docker-py won't cast from string to int
             cpu_shares = int(container_config.cpu_shares)
 
+        self.docker_network = bool(container_config.docker_network)
+        self.endpoint_config = docker.types.EndpointConfig(version=version)
+        # The command is a template, rendered for each launch by container_body.
+        self.command = container_config.command
+        self.container_ip = container_config.container_ip
+        self.body = docker.types.ContainerConfig(version=version,
+                                                 image=container_config.image,
+                                                 user=container_config.container_user,
+                                                 command='',
+                                                 volumes=volumes,
+                                                 host_config=host_config,
+                                                 networking_config=networking_config,
+                                                 cpu_shares=cpu_shares)
+
+    def container_body(self, labels=None, cpuset=None, base_path='', port=None, token='',
+                       network=None):
+        '''The body of a create call for one container, carrying `labels` and pinned to the
+        (node, cpus) `cpuset` if one is given. With a docker network, the container joins
+        `network` at creation, rather than connecting in a second call.
+
+        The command template is rendered with the container's `base_path`, `port` and `token`,
+        so that its server knows where the proxy routes it and how to authenticate users.'''
+
+        body = dict(self.body)
+        body['Labels'] = labels
+        host_config = body['HostConfig'] = dict(body['HostConfig'])
+        if self.docker_network and network:
+            host_config['NetworkMode'] = network
+            body['NetworkingConfig'] = {'EndpointsConfig': {network: self.endpoint_config}}
+        if self.command:
+            body['Cmd'] = [
+                "/bin/sh",
+                "-c",
+                self.command.format(base_path=base_path, port=port, ip=self.container_ip,
+                                    token=token),
+            ]
+        if cpuset is not None:
+            node, cpus = cpuset
+            host_config['CpusetCpus'] = ','.join(str(cpu) for cpu in cpus)
+            if node is not None:
+                host_config['CpusetMems'] = str(node)
+        return body
+
+
+class DockerSpawner():
+    def __init__(self,
+                 docker_host='unix://var/run/docker.sock',
+                 version='auto',
+                 timeout=30,
+                 max_connections=64,
+                 assert_hostname=False,
+                 concurrency=None,
+                 port_range=None,
+                 cpuset_size=None,
+                 ):
+
+        #kwargs = kwargs_from_env(assert_hostname=False)
+        kwargs = kwargs_from_env(assert_hostname=assert_hostname)
+
+        # environment variable DOCKER_HOST takes precedence
+        kwargs.setdefault('base_url', docker_host)
+
+        self.docker_client = dockerapi.DockerEngineClient(version=version,
+                                                          timeout=timeout,
+                                                          max_connections=max_connections,
+                                                          **kwargs)
 
-        #self.docker_client.create_network('picaso1') 
-        #networking_config = self.docker_client.create_networking_config({'picaso1': self.docker_client.create_endpoint_config()
-        #})
+        self._events_since = None
+        self._templates = {}
 
-        endpoint_config = yield self.docker_client.create_endpoint_config()
-        networking_config = yield self._with_retries( self.docker_client.create_networking_config,
-            { container_config.docker_network: endpoint_config})
+        limits = dict(CONCURRENCY)
+        limits.update(concurrency or {})
+        unknown = set(limits) - set(OPERATION_CLASSES)
+        if unknown:
+            raise ValueError("Unknown Docker operation classes: {}".format(", ".join(unknown)))
+        self.bulkheads = dict((name, Bulkhead(name, limits[name], LATENCY_TARGETS[name]))
+                              for name in OPERATION_CLASSES)
+        self.breaker = CircuitBreaker()
 
-        app_log.info('networking_config %s', networking_config)
+        # Ports for containers on the host network or a docker network, allocated from
+        # port_range (or DEFAULT_PORT_SPAN ports from the container port) on first use.
+        self.port_range = port_range
+        self.ports = None
+        self._container_ports = {}
+        # Optional NUMA-aware CPU pinning.
+        self.cpusets = CpusetAllocator(cpuset_size) if cpuset_size else None
+        self._container_cpusets = {}
 
-        resp = yield self._with_retries(self.docker_client.create_container,
-                                        image=container_config.image,
-                                        user=container_config.container_user,
-                                        command='',  
-                                        volumes=volumes,
-                                        host_config=host_config,
-                                        # networking_config=networking_config,
-                                        cpu_shares=cpu_shares,
-                                        name=container_name)
+    @gen.coroutine
+    def create_notebook_server(self, base_path, container_name, container_config, labels=None):
+        '''Creates and starts a notebook_server running off of `base_path`, tagged with `labels`.
+
+        Returns the (container_id, ip, port, token) tuple in a Future.'''
+
+        container_id, port, token = yield self.create_notebook_container(
+            base_path, container_name, container_config, labels)
+        host_ip, host_port = yield self.start_notebook_container(container_id, port,
+                                                                 container_config)
+        raise gen.Return((container_id, host_ip, host_port, token))
+
+    @gen.coroutine
+    def launch_template(self, container_config):
+        '''The LaunchTemplate for `container_config`, compiled the first time it is needed.'''
+
+        version = yield self.docker_client.api_version()
+        key = (template_key(container_config), version)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = LaunchTemplate(container_config, version)
+            app_log.info("Compiled launch template for %s: %s", container_config.image,
+                         template.body)
+        raise gen.Return(template)
+
+    @gen.coroutine
+    def create_notebook_container(self, base_path, container_name, container_config,
+                                  labels=None):
+        '''Creates, but does not start, a notebook_server running off of `base_path`.
+
+        Returns the (container_id, port, token) tuple in a Future.'''
+
+        template = yield self.launch_template(container_config)
+
+        if template.fixed_port:
+            port = self._reserve_port(container_config)
+        else:
+            port = container_config.container_port
+
+        if container_config.use_tokens:
+            # Generate token for authenticating first request (requires notebook 4.3)
+            # making each server semi-private for the user who is first assigned.
+            token = binascii.hexlify(os.urandom(24)).decode('ascii')
+        else:
+            token = ''
+
+        cpuset = self.cpusets.reserve() if self.cpusets else None
+
+        body = template.container_body(labels, cpuset, base_path=base_path, port=port,
+                                       token=token, network=container_config.docker_network)
+        try:
+            resp = yield self._call(LAUNCH, self.docker_client.create_container, body,
+                                    name=container_name)
+        except Exception:
+            if template.fixed_port:
+                self.ports.release(port)
+            if cpuset is not None:
+                self.cpusets.release(cpuset)
+            raise
 
-        
         docker_warnings = resp.get('Warnings')
         if docker_warnings is not None:
             app_log.warning(docker_warnings)
 
         container_id = resp['Id']
         app_log.info("Created container {}".format(container_id))
-        
-        print('container_config', container_config) 
-        print("Created container {}".format(container_id))
-
-        if container_config.docker_network:
-            app_log.info('Connecting to docker network {%s}', container_config.docker_network)
-            yield self._with_retries(self.docker_client.connect_container_to_network,
-                                            container_id,
-                                            container_config.docker_network,
-            )
-        app_log.info('starting container')
-             
-        yield self._with_retries(self.docker_client.start,
+        if template.fixed_port:
+            self._container_ports[container_id] = port
+        if cpuset is not None:
+            self._container_cpusets[container_id] = cpuset
+        raise gen.Return((container_id, port, token))
+
+    def _reserve_port(self, container_config):
+        return self._port_allocator(container_config).reserve()
+
+    def _port_allocator(self, container_config):
+        if self.ports is None:
+            start, end = self.port_range or (
+                int(container_config.container_port),
+                min(65535, int(container_config.container_port) + DEFAULT_PORT_SPAN - 1))
+            # Only the host network is shared with the rest of the host.
+            host_ip = container_config.container_ip if container_config.host_network else None
+            self.ports = PortAllocator(start, end, host_ip)
+        return self.ports
+
+    @gen.coroutine
+    def adopt_notebook_server(self, container_id, port, container_config):
+        '''Take back the port and cpuset of a container left running by a previous run, so
+        that they aren't handed to another.'''
+
+        template = yield self.launch_template(container_config)
+        if template.fixed_port and port is not None:
+            port = int(port)
+            self._port_allocator(container_config).claim(port)
+            self._container_ports[container_id] = port
+        if self.cpusets:
+            info = yield self._call(INSPECT, self.docker_client.inspect_container, container_id)
+            host_config = info.get('HostConfig') or {}
+            cpus = parse_cpulist(host_config.get('CpusetCpus') or '')
+            if cpus:
+                mems = host_config.get('CpusetMems')
+                cpuset = (int(mems) if mems else None, cpus)
+                self.cpusets.claim(cpuset)
+                self._container_cpusets[container_id] = cpuset
+
+    def _release_resources(self, container_id):
+        '''Return the port and cpuset held by a container that has been removed.'''
+
+        port = self._container_ports.pop(container_id, None)
+        if port is not None:
+            self.ports.release(port)
+        cpuset = self._container_cpusets.pop(container_id, None)
+        if cpuset is not None:
+            self.cpusets.release(cpuset)
+
+    @gen.coroutine
+    def start_notebook_container(self, container_id, port, container_config):
+        '''Starts a container made by create_notebook_container.
+
+        Returns the (ip, port) tuple the notebook server can be reached at in a Future.'''
+
+        yield self._call(LAUNCH, self.docker_client.start,
                                  container_id)
-        
-        app_log.info('docker_client.port',container_config.container_port)
 
         if container_config.host_network:
             host_port = port
             host_ip = container_config.container_ip
         elif container_config.docker_network:
-            container_info = yield self._with_retries(self.docker_client.inspect_container, container_id)
+            container_info = yield self._call(LAUNCH, self.docker_client.inspect_container, container_id)
 
             host_port  = port
             # get ip of container on the specified docker network
             host_ip = container_info['NetworkSettings']['Networks'][container_config.docker_network]['IPAddress']
 
         else:
-            app_log.info('docker_client.port',container_config.container_port)
-            container_network = yield self._with_retries(self.docker_client.port,
+            container_network = yield self._call(LAUNCH, self.docker_client.port,
                                                         container_id,
                                                         container_config.container_port)            
             host_port = container_network[0]['HostPort']
             host_ip =  container_network[0]['HostIp']  
 
 
-        raise gen.Return((container_id, host_ip, int(host_port), token))
+        raise gen.Return((host_ip, int(host_port)))
 
     @gen.coroutine
     def shutdown_notebook_server(self, container_id, alive=True):
         '''Gracefully stop a running container.'''
 
         if alive:
-            yield self._with_retries(self.docker_client.stop, container_id)
-        yield self._with_retries(self.docker_client.remove_container, container_id)
+            yield self._call(TEARDOWN, self.docker_client.stop, container_id)
+        yield self._call(TEARDOWN, self.docker_client.remove_container, container_id)
+        self._release_resources(container_id)
+
+    @gen.coroutine
+    def destroy_notebook_server(self, container_id):
+        '''Kill and remove a container in one call. A container that is already gone counts as
+        removed.'''
+
+        try:
+            yield self._call(TEARDOWN, self.docker_client.remove_container, container_id,
+                             force=True)
+        except dockerapi.DockerAPIError as e:
+            if e.status_code != 404:
+                raise
+        self._release_resources(container_id)
+
+    @gen.coroutine
+    def pause_notebook_server(self, container_id):
+        '''Freeze every process in a running container.'''
+
+        yield self._call(TEARDOWN, self.docker_client.pause, container_id)
+
+    @gen.coroutine
+    def unpause_notebook_server(self, container_id):
+        '''Thaw a container frozen by pause_notebook_server.'''
+
+        yield self._call(LAUNCH, self.docker_client.unpause, container_id)
+
+    @gen.coroutine
+    def resize_notebook_server(self, container_id, mem_limit):
+        '''Change the memory limit of a running container.
+
+        Swap is capped at the same allowance Docker gives a container created with `mem_limit`,
+        since the limit can't be raised past the swap limit the container was created with.'''
+
+        mem_bytes = parse_bytes(mem_limit)
+        yield self._call(LAUNCH, self.docker_client.update_container,
+                                 container_id,
+                                 mem_limit=mem_bytes,
+                                 memswap_limit=2 * mem_bytes)
+
+    @gen.coroutine
+    def create_network(self, name, internal=False, labels=None, attach=()):
+        '''Create a bridge network, without egress if `internal`, and connect the containers in
+        `attach` (such as the proxy) to it.'''
+
+        yield self._call(TEARDOWN, self.docker_client.create_network, name,
+                         internal=internal, labels=labels)
+        for container in attach:
+            yield self._call(TEARDOWN, self.docker_client.connect_container_to_network,
+                             container, name)
+
+    @gen.coroutine
+    def remove_network(self, name):
+        '''Remove a network. A network that is already gone counts as removed.'''
+
+        try:
+            yield self._call(TEARDOWN, self.docker_client.remove_network, name)
+        except dockerapi.DockerAPIError as e:
+            if e.status_code != 404:
+                raise
+
+    @gen.coroutine
+    def list_networks(self, labels):
+        '''List the networks tagged with all of `labels`.'''
+
+        networks = yield self._call(INSPECT, self.docker_client.networks,
+                                    filters=label_filters(labels))
+        raise gen.Return(networks)
+
+    @gen.coroutine
+    def inspect_network(self, name):
+        '''Inspect a network, or return None if it is gone.'''
+
+        try:
+            info = yield self._call(INSPECT, self.docker_client.inspect_network, name)
+        except dockerapi.DockerAPIError as e:
+            if e.status_code != 404:
+                raise
+            info = None
+        raise gen.Return(info)
+
+    @gen.coroutine
+    def inspect_image(self, image):
+        '''Inspect a local image, or return None if it isn't on this host.'''
+
+        try:
+            info = yield self._call(INSPECT, self.docker_client.inspect_image, image)
+        except dockerapi.DockerAPIError as e:
+            if e.status_code != 404:
+                raise
+            info = None
+        raise gen.Return(info)
 
     @gen.coroutine
-    def list_notebook_servers(self, pool_regex, all=True):
-        '''List containers that are managed by a specific pool.'''
+    def remote_digest(self, image):
+        '''The digest `image` currently points to in its registry, or None if the registry (or an
+        older daemon) can't say.
+
+        The daemon asks the registry on our behalf, so a failure here is usually the registry's.
+        The call is made without retries and bypasses the circuit breaker and bulkheads, so a
+        registry outage is not mistaken for trouble with the daemon.'''
 
-        existing = yield self._with_retries(self.docker_client.containers,
-                                            all=all,
-                                            trunc=False)
+        try:
+            info = yield self.docker_client.inspect_distribution(image)
+        except dockerapi.DockerError as e:
+            app_log.debug("Unable to look up [%s] in its registry: %s", image, e)
+            raise gen.Return(None)
+        raise gen.Return(info.get('Descriptor', {}).get('digest'))
 
-        def name_matches(container):
+    @gen.coroutine
+    def pull_image(self, repository, tag=None, progress=None):
+        '''Pull an image, calling `progress(document)` with each progress report as it streams
+        in.'''
+
+        @gen.coroutine
+        def pull():
+            reports = yield self._with_retries(self.docker_client.pull, repository, tag)
             try:
-                names = container['Names']
-                if names is None:
-                  app_log.warn("Docker API returned null Names, ignoring")
-                  return False
-            except Exception:
-                app_log.warn("Invalid container: %r", container)
-                return False
-            for name in names:
-                if pool_regex.search(name):
-                    return True
-            return False
+                while True:
+                    report = yield reports.read_json()
+                    if report is None:
+                        break
+                    if 'error' in report:
+                        raise dockerapi.DockerAPIError(500, report['error'])
+                    if progress is not None:
+                        progress(report)
+            finally:
+                reports.close()
+        # Like a copy, the whole transfer holds its slot.
+        yield self.bulkheads[BULK].run(pull)
+
+    @gen.coroutine
+    def exec_in_container(self, container_id, command, user=None):
+        '''Runs `command` (a list) in a running container and waits for it to exit.
+
+        Returns the (exit_code, output) tuple in a Future, with stdout and stderr interleaved
+        in the output.'''
+
+        @gen.coroutine
+        def run():
+            exec_id = yield self._with_retries(self.docker_client.exec_create, container_id,
+                                               command, user=user)
+            stream = yield self.docker_client.exec_start(exec_id)
+            try:
+                output = yield stream.read_all()
+            finally:
+                stream.close()
+            info = yield self.docker_client.exec_inspect(exec_id)
+            raise gen.Return((info['ExitCode'], demultiplex(output)))
+        # The command holds its slot until it exits.
+        result = yield self.bulkheads[BULK].run(run)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def commit_container(self, container_id, repository, tag, labels=None, comment=None):
+        '''Snapshots a container as the image `repository`:`tag`, carrying `labels`.
+
+        Returns the new image's id in a Future.'''
+
+        # Writing out the container's layer can take far longer than a regular call.
+        image_id = yield self._call(BULK, self.docker_client.commit, container_id,
+                                    repository=repository, tag=tag, labels=labels,
+                                    comment=comment, request_timeout=COMMIT_TIMEOUT)
+        raise gen.Return(image_id)
+
+    @gen.coroutine
+    def list_notebook_servers(self, labels, all=True):
+        '''List containers that are managed by a specific pool, identified by its `labels`.
+
+        The filtering is done by the Docker daemon, so only the pool's own containers are sent.'''
 
-        matching = [container for container in existing if name_matches(container)]
+        matching = yield self._call(INSPECT, self.docker_client.containers,
+                                    all=all,
+                                    filters=label_filters(labels))
         raise gen.Return(matching)
 
+    @gen.coroutine
+    def watch_events(self, callback, filters=None, retry_delay=1):
+        '''Follow the Docker event stream, calling `callback(event)` on the IOLoop for each event.
+
+        The stream is reopened from the last event seen whenever the daemon drops it, so this
+        never returns.'''
+
+        while True:
+            try:
+                events = yield self.docker_client.events(since=self._events_since,
+                                                         filters=filters)
+                try:
+                    while True:
+                        event = yield events.read_json()
+                        if event is None:
+                            break
+                        self._events_since = event.get('time', self._events_since)
+                        callback(event)
+                finally:
+                    events.close()
+            except dockerapi.DockerError as e:
+                app_log.debug("Docker event stream interrupted: %s", e)
+            yield gen.sleep(retry_delay)
+
+    def operation_stats(self):
+        '''Concurrency, queue depth and wait times for each class of operation.'''
+
+        return dict((name, bulkhead.stats()) for name, bulkhead in self.bulkheads.items())
+
+    @property
+    def overloaded(self):
+        '''Whether the daemon is under pressure: the circuit breaker has tripped, or launches are
+        queueing up faster than they are let through.'''
+
+        launch = self.bulkheads[LAUNCH]
+        return self.breaker.state != CircuitBreaker.CLOSED or launch.queued > launch.limit
+
+    def _call(self, operation, fn, *args, **kwargs):
+        '''Make a Docker API call, with retries, within the budget of its operation class.'''
+
+        return self._with_retries(fn, *args, operation=operation, **kwargs)
+
     @gen.coroutine
     def _with_retries(self, fn, *args, **kwargs):
         '''Attempt a Docker API call.
 
-        If an error occurs, retry up to "max_tries" times before letting the exception propagate
-        up the stack.''' 
-        max_tries = kwargs.get('max_tries', RETRIES)
-        try:
-            if 'max_tries' in kwargs:
-                del kwargs['max_tries']
-            result = yield fn(*args, **kwargs)
-            raise gen.Return(result)
-        except (docker.errors.APIError, requests.exceptions.RequestException) as e:
-            app_log.error("Encountered a Docker error with {} ({} retries remain): {}".format(fn.__name__, max_tries, e))
-            if max_tries > 0:
-                kwargs['max_tries'] = max_tries - 1
-                result = yield self._with_retries(fn, *args, **kwargs)
+        If a transient error occurs, retry up to "max_tries" times, backing off exponentially with
+        jitter, before letting the exception propagate up the stack. Calls are refused with a
+        CircuitOpenError while the circuit breaker is open.'''
+        max_tries = kwargs.pop('max_tries', RETRIES)
+        operation = kwargs.pop('operation', None)
+        attempt = 0
+        while True:
+            try:
+                result = yield self._attempt(operation, fn, *args, **kwargs)
                 raise gen.Return(result)
-            else:
-                raise e
+            except dockerapi.DockerError as e:
+                if not is_transient(e) or attempt >= max_tries:
+                    raise
+                delay = backoff(attempt)
+                app_log.error("Encountered a Docker error with {} ({} retries remain, next in "
+                              "{:.2f}s): {}".format(fn.__name__, max_tries - attempt, delay, e))
+                attempt += 1
+                yield gen.sleep(delay)
 
     @gen.coroutine
-    def copy_files(self, container_id, path):
-        '''Returns a tarball of path from container_id'''
-        tarball = yield self.docker_client.copy(container_id, path)
-        raise gen.Return(tarball)
+    def _attempt(self, operation, fn, *args, **kwargs):
+        '''Make a single call through the circuit breaker, and the bulkhead of its operation
+        class if it has one.'''
+
+        if not self.breaker.allow():
+            raise CircuitOpenError("Not calling {}: the Docker daemon is failing and the circuit "
+                                   "breaker is open.".format(fn.__name__))
+
+        @gen.coroutine
+        def call():
+            loop = ioloop.IOLoop.current()
+            started = loop.time()
+            try:
+                result = yield fn(*args, **kwargs)
+            except Exception as e:
+                self.breaker.record(is_transient(e))
+                raise
+            # Teardowns and copies are slow by nature, so only other calls count against the
+            # daemon's latency.
+            slow = (operation in (LAUNCH, INSPECT) and
+                    loop.time() - started > self.breaker.slow_call)
+            self.breaker.record(slow)
+            raise gen.Return(result)
+
+        if operation is None:
+            result = yield call()
+        else:
+            result = yield self.bulkheads[operation].run(call)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def container_logs(self, container_id, tail=100):
+        '''Returns the last `tail` lines a container wrote to stdout and stderr, as text.'''
+
+        @gen.coroutine
+        def logs():
+            stream = yield self.docker_client.logs(container_id, tail=tail)
+            try:
+                body = yield stream.read_all()
+            finally:
+                stream.close()
+            raise gen.Return(body)
+        body = yield self._call(INSPECT, logs)
+        raise gen.Return(demultiplex(body))
+
+    @gen.coroutine
+    def copy_files(self, container_id, path, destination):
+        '''Writes a tarball of path from container_id to the file object destination, as it
+        streams in.'''
+        @gen.coroutine
+        def copy():
+            archive = yield self._with_retries(self.docker_client.get_archive, container_id, path)
+            try:
+                while True:
+                    chunk = yield archive.read_chunk()
+                    if chunk is None:
+                        break
+                    destination.write(chunk)
+            finally:
+                archive.close()
+        # The whole transfer holds the slot, not just opening the archive.
+        yield self.bulkheads[BULK].run(copy)
@@ -4,6 +4,7 @@
 import datetime
 import os
 import re
+import socket
 from textwrap import dedent
 import uuid
 import logging
@@ -16,8 +17,10 @@ from tornado.log import app_log
 from tornado.web import RequestHandler, HTTPError, RedirectHandler
 
 from tornado import gen, web
+from tornado.concurrent import Future
 
 import dockworker
+import poolstore
 import spawnpool
 
 
@@ -101,10 +104,22 @@ class APIStatsHandler(BaseHandler):
         '''Returns some statistics/metadata about the tmpnb server'''
         self.set_header("Content-Type", 'application/json')
         response = {
+                'status': self.pool.phase,
                 'available': len(self.pool.available),
                 'capacity': self.pool.capacity,
+                'max_capacity': self.pool.max_capacity,
+                'containers': self.pool.registry.counts(),
+                'docker': self.pool.spawner.operation_stats(),
+                'docker_circuit': self.pool.spawner.breaker.stats(),
+                'reaping': len(self.pool.reaper),
+                'boot': self.pool.probe.stats(),
+                'admission': self.pool.admission_stats(),
+                'ports': self.pool.spawner.ports.stats() if self.pool.spawner.ports else None,
+                'networks': len(self.pool.networks) if self.pool.networks else None,
+                'cpusets': self.pool.spawner.cpusets.stats() if self.pool.spawner.cpusets else None,
                 'version': '0.2.0',
                 'container_image': self.pool.container_config.image,
+                'image': self.pool.images.stats(),
         }
         self.write(response)
 
@@ -113,6 +128,21 @@ class APIStatsHandler(BaseHandler):
         return self.settings['pool']
 
 
+class APIReadyHandler(BaseHandler):
+    def get(self):
+        '''Reports whether this node has containers to hand out, for load balancer health
+        checks: 200 if it does, 503 while it is starting up or has none available.'''
+        available = len(self.pool.available)
+        phase = self.pool.phase
+        if phase == spawnpool.STARTING or not available:
+            self.set_status(503)
+        self.write({'status': phase, 'available': available})
+
+    @property
+    def pool(self):
+        return self.settings['pool']
+
+
 class InfoHandler(BaseHandler):
     def get(self):
         self.render("stats.html")
@@ -124,6 +154,14 @@ class InfoHandler(BaseHandler):
 
 class SpawnHandler(BaseHandler):
 
+    def initialize(self):
+        # Resolved if the client goes away while waiting for a container.
+        self.disconnected = Future()
+
+    def on_connection_close(self):
+        if not self.disconnected.done():
+            self.disconnected.set_result(None)
+
     @gen.coroutine
     def get(self, path=None):
         '''Spawns a brand new server'''
@@ -137,13 +175,15 @@ class SpawnHandler(BaseHandler):
 
                 # Scrap a container from the pool and replace it with an ad-hoc replacement.
                 # This takes longer, but is necessary to support ad-hoc containers
-                container = yield self.pool.adhoc(user)
+                container = yield self.pool.adhoc(user, self.spawn_timeout)
 
                 url = path
             else:
                 # There is no path or it represents a subpath of the notebook server
-                # Assign a prelaunched container from the pool and redirect to it.
-                container = self.pool.acquire()
+                # Assign a prelaunched container from the pool and redirect to it, holding the
+                # request open for a little while if one is still being launched.
+                container = yield self.pool.acquire_wait(self.spawn_timeout,
+                                                         cancelled=self.disconnected)
                 container_path = container.path
                 app_log.info("Allocated [%s] from the pool.", container_path)
 
@@ -162,6 +202,9 @@ class SpawnHandler(BaseHandler):
             app_log.info("Redirecting [%s] -> [%s].", self.request.path, url)
             self.redirect(url, permanent=False)
         except spawnpool.EmptyPoolError:
+            if self.disconnected.done():
+                app_log.info("Client went away while waiting for a container.")
+                return
             app_log.warning("The container pool is empty!")
             self.render("full.html", cull_period=self.cull_period)
 
@@ -177,6 +220,10 @@ class SpawnHandler(BaseHandler):
     def redirect_uri(self):
         return self.settings['redirect_uri']
 
+    @property
+    def spawn_timeout(self):
+        return self.settings['spawn_timeout']
+
 
 class APISpawnHandler(BaseHandler):
 
@@ -185,22 +232,75 @@ class APISpawnHandler(BaseHandler):
     def post(self):
         '''Spawns a brand new server programmatically'''
         try:
-            container = self.pool.acquire()
-            url = container.path
-            if container.token:
-                url = url_concat(url, {'token': container.token})
+            container = yield self.pool.acquire_wait()
+            url = container_url(container)
             app_log.info("Allocated [%s] from the pool.", url)
             app_log.debug("Responding with container url [%s].", url)
             self.write({'url': url})
         except spawnpool.EmptyPoolError:
-            app_log.warning("The container pool is empty!")
+            if not self.spawn_timeout:
+                app_log.warning("The container pool is empty!")
+                self.set_status(429)
+                self.write({'status': 'full'})
+                return
+            job = self.pool.submit_job(self.spawn_timeout)
+            app_log.info("The container pool is empty, queued spawn job [%s].", job.id)
+            self.set_status(202)
+            self.set_header('Location', '/api/spawn/{}'.format(job.id))
+            self.write({'status': job.status, 'id': job.id})
+
+    @property
+    def pool(self):
+        return self.settings['pool']
+
+    @property
+    def spawn_timeout(self):
+        return self.settings['spawn_timeout']
+
+
+class APISpawnJobHandler(BaseHandler):
+
+    @web.authenticated
+    @gen.coroutine
+    def get(self, job_id):
+        '''Reports on a queued spawn job, optionally waiting up to `?wait=<seconds>` for it.'''
+        job = self.pool.jobs.get(job_id)
+        if job is None:
+            raise HTTPError(404)
+
+        wait = float(self.get_argument('wait', 0))
+        if wait and not job.future.done():
+            try:
+                yield gen.with_timeout(datetime.timedelta(seconds=wait), job.future)
+            except (gen.TimeoutError, spawnpool.EmptyPoolError):
+                pass
+
+        status = job.status
+        if status == 'ready':
+            # Hand the container out exactly once.
+            self.pool.jobs.pop(job.id, None)
+            self.write({'status': status, 'id': job.id, 'url': container_url(job.container)})
+        elif status == 'full':
+            self.pool.jobs.pop(job.id, None)
             self.set_status(429)
-            self.write({'status': 'full'})
+            self.write({'status': status, 'id': job.id})
+        else:
+            self.set_status(202)
+            self.write({'status': status, 'id': job.id})
 
     @property
     def pool(self):
         return self.settings['pool']
 
+
+def container_url(container):
+    '''Build the URL a client should visit to use a container.'''
+    url = container.path
+    if container.token:
+        url = url_concat(url, {'token': container.token})
+    return url
+
+
 class AdminHandler(RequestHandler):
 
     def get_current_user(self):
@@ -232,11 +332,85 @@ class APIPoolHandler(AdminHandler):
     def pool(self):
         return self.settings['pool']
 
+class APIQuarantineHandler(AdminHandler):
+    @web.authenticated
+    def get(self):
+        '''Lists the containers that most recently failed to launch, with their logs.'''
+        self.finish(dict(quarantine=list(self.pool.quarantine)))
+
+    @property
+    def pool(self):
+        return self.settings['pool']
+
+class APIPoolUpgradeHandler(AdminHandler):
+    @web.authenticated
+    def get(self):
+        '''Reports the progress of the current or last rolling upgrade.'''
+        self.finish(dict(upgrade=self.pool.rollout))
+
+    @web.authenticated
+    def post(self):
+        '''Starts a rolling upgrade of the pool to the newest image.'''
+        surge = self.get_argument('surge', None)
+        if surge is not None:
+            try:
+                surge = int(surge)
+            except ValueError:
+                raise HTTPError(400, "surge must be an integer")
+        if not self.pool.upgrade(surge):
+            raise HTTPError(409, "An upgrade is already in progress")
+        app_log.info('Started a rolling upgrade of the pool')
+        self.set_status(202)
+        self.finish(dict(upgrade=self.pool.rollout))
+
+    @property
+    def pool(self):
+        return self.settings['pool']
+
+def inherited_sockets():
+    '''Listening sockets handed down by a supervisor with the systemd socket activation protocol
+    (LISTEN_PID and LISTEN_FDS), in the order they were passed.
+
+    A supervisor that holds the sockets can restart the orchestrator without refusing a single
+    connection: requests queue in the kernel until the new process accepts them.'''
+
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return []
+    sockets = []
+    for fd in range(3, 3 + int(os.environ.get('LISTEN_FDS', 0))):
+        sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+        sock.setblocking(False)
+        sockets.append(sock)
+    return sockets
+
+def listen(server, sock, port, address):
+    if sock is not None:
+        app_log.info("Serving on an inherited socket at %s", sock.getsockname())
+        server.add_sockets([sock])
+    else:
+        server.listen(port, address)
+
 def main(): 
 
     tornado.options.define('cull_period', default=600,
         help="Interval (s) for culling idle containers."
     )
+    tornado.options.define('reap_batch_size', default=10,
+        help=dedent("""
+        Maximum number of released containers to kill and remove at once.
+        Released containers are unrouted right away and removed from Docker
+        in the background, in batches.""")
+    )
+    tornado.options.define('reap_interval', default=1.0,
+        help="Minimum interval (s) between batches of container removals."
+    )
+    tornado.options.define('reconcile_period', default=300,
+        help=dedent("""
+        Interval (s) for checking the pool's record of its containers against
+        Docker. Container deaths are normally picked up straight away from the
+        Docker event stream; this is a safety net.""")
+    )
     tornado.options.define('cull_timeout', default=3600,
         help="Timeout (s) for culling idle containers."
     )
@@ -275,6 +449,43 @@ If host_network=True, the starting port assigned to notebook servers on the host
         help="""Command to run when booting the image. A placeholder for
 {base_path} should be provided. A placeholder for {port} and {ip} can be provided."""
     )
+    tornado.options.define('probe_endpoint', default=None,
+        help=dedent("""
+        Endpoint, relative to the container's base path, that answers once the
+        server in a new container is ready. Defaults to api/kernelspecs for
+        kernel gateway commands and api otherwise.""")
+    )
+    tornado.options.define('boot_timeout', default=30,
+        help=dedent("""
+        Time (s) allowed for the server in a new container to become ready
+        before the container is discarded.""")
+    )
+    tornado.options.define('quarantine_size', default=10,
+        help=dedent("""
+        Number of failed launches, with the logs of their containers, kept for
+        /api/pool/quarantine on the admin API.""")
+    )
+    tornado.options.define('image_failure_threshold', default=5,
+        help=dedent("""
+        Number of containers of the image that may fail to boot in a row before
+        refills are paused.""")
+    )
+    tornado.options.define('image_failure_pause', default=60,
+        help=dedent("""
+        Time (s) refills are paused for once the image keeps failing to boot.
+        Requests that are waiting for a container still launch one.""")
+    )
+    tornado.options.define('cleanout_concurrency', default=16,
+        help=dedent("""
+        Number of containers left over from a previous run to remove at once
+        during startup.""")
+    )
+    tornado.options.define('state_db', default=None,
+        help=dedent("""
+        Path of a SQLite database to keep the pool's containers in. On startup,
+        containers recorded there that are still healthy are adopted, in use or
+        not, instead of being removed.""")
+    )
     tornado.options.define('port', default=9999,
         help="port for the main server to listen on"
     )
@@ -287,8 +498,21 @@ If host_network=True, the starting port assigned to notebook servers on the host
     tornado.options.define('admin_ip', default='127.0.0.1',
         help="ip for the admin server to listen on [default: 127.0.0.1]"
     )
-    tornado.options.define('max_dock_workers', default=2,
-        help="Maximum number of docker workers"
+    tornado.options.define('max_dock_workers', default=64,
+        help="Maximum number of concurrent calls to the Docker daemon"
+    )
+    tornado.options.define('docker_concurrency', default=[], multiple=True,
+        help=dedent("""
+        Concurrency budgets for classes of Docker operation, as a comma-delimited
+        list of class=limit pairs, e.g. launch=32,teardown=8. The classes are
+        launch, inspect, teardown and bulk; each queues separately, so a backlog
+        of teardowns can't hold up launches.""")
+    )
+    tornado.options.define('launch_concurrency', default=4,
+        help="Maximum number of containers being created and started at once"
+    )
+    tornado.options.define('launch_rate', default=10.0,
+        help="Maximum number of container launches started per second (0 for no limit)"
     )
     tornado.options.define('mem_limit', default="512m",
         help="Limit on Memory, per container"
@@ -306,8 +530,40 @@ If host_network=True, the starting port assigned to notebook servers on the host
 
         """)
     )
+    tornado.options.define('cpuset_size', default=0,
+        help=dedent("""
+        Pin each container to this many CPUs, and the memory, of a single NUMA
+        node, balancing containers across the host's nodes and CPUs. Disabled by
+        default (0).""")
+    )
     tornado.options.define('image', default="jupyter/minimal-notebook",
-        help="Docker container to spawn for new users. Must be on the system already"
+        help=dedent("""
+        Docker image to spawn for new users. It is pulled at startup if it isn't on
+        the system already, and containers are created from the exact image the tag
+        pointed to.""")
+    )
+    tornado.options.define('image_check_period', default=300,
+        help=dedent("""
+        Interval (s) for checking whether the image tag has moved. A new image is
+        pulled in the background and used for new containers once it is ready.
+        0 disables checking.""")
+    )
+    tornado.options.define('warmup_script', default=None,
+        help=dedent("""
+        Shell script to warm up a booted container of the image with, for
+        example by importing libraries and building caches. When set, a
+        container is booted, warmed up and committed as a warm image, which pool
+        containers are then created from. It is baked again whenever the image
+        changes. The server's Jupyter runtime directory is cleared before the
+        commit, so files the script leaves there are not kept.""")
+    )
+    tornado.options.define('warm_repository', default=None,
+        help=dedent("""
+        Repository to commit warm images to, tagged with the digest of the image
+        they were baked from. Defaults to tmpnb-warm/<pool_name>.""")
+    )
+    tornado.options.define('warmup_timeout', default=600,
+        help="Time (s) the warmup script may run for before baking is abandoned."
     )
     tornado.options.define('docker_version', default="auto",
         help="Version of the Docker API to use"
@@ -318,6 +574,52 @@ If host_network=True, the starting port assigned to notebook servers on the host
     tornado.options.define('pool_size', default=1,
         help="Capacity for containers on this system. Will be prelaunched at startup."
     )
+    tornado.options.define('spawn_timeout', default=30,
+        help=dedent("""
+        Seconds a spawn request may wait for a container to finish launching
+        when the pool is empty. Browsers are held open while API clients get
+        a 202 with a job id to poll at /api/spawn/<id>. Use 0 to reject
+        immediately.""")
+    )
+    tornado.options.define('pool_max', default=None, type=int,
+        help=dedent("""
+        Maximum number of containers, in use or pooled, that may run during a
+        surge of waiting spawn requests. Burst containers are not replaced once
+        culled. Defaults to pool_size.""")
+    )
+    tornado.options.define('created_pool_size', default=0,
+        help=dedent("""
+        Number of containers to keep created, but not started, behind the
+        running pool. Refilling the pool from these only needs a start.""")
+    )
+    tornado.options.define('pooled_mem_limit', default=None,
+        help=dedent("""
+        Memory limit for containers while they wait in the pool. It is raised
+        to mem_limit when a container is handed out, so more warm containers
+        fit on a host. Defaults to mem_limit.""")
+    )
+    tornado.options.define('pause_pooled', default=False,
+        help=dedent("""
+        Pause containers (with the cgroup freezer) while they wait in the pool
+        and unpause them when they are handed out, so idle pooled containers
+        use no CPU.""")
+    )
+    tornado.options.define('upgrade_surge', default=1,
+        help=dedent("""
+        Number of containers a rolling upgrade may launch beyond pool_size at
+        once. Old containers are only retired once their replacements are
+        ready.""")
+    )
+    tornado.options.define('pool_low_water', default=None, type=int,
+        help=dedent("""
+        Refill the pool in the background as soon as fewer than this many
+        containers are available. Defaults to pool_high_water.""")
+    )
+    tornado.options.define('pool_high_water', default=None, type=int,
+        help=dedent("""
+        Number of available containers a background refill aims for, bounded
+        by pool_size. Defaults to pool_size.""")
+    )
     tornado.options.define('pool_name', default=None,
         help="Container name fragment used to identity containers that belong to this instance."
     )
@@ -352,10 +654,32 @@ If host_network=True, the starting port assigned to notebook servers on the host
         help="""Attaches the containers to the host networking instead of the
 default docker bridge. Affects the semantics of container_port and container_ip."""
     )
+    tornado.options.define('port_range', default=None,
+        help=dedent("""
+        Range of ports, as start-end, to give containers on the host network or a
+        docker network. Ports are reused once their containers are removed, and
+        with host_network ports already bound on the host are skipped. Defaults to
+        10000 ports starting at container_port.""")
+    )
     tornado.options.define('docker_network', default=None,
         help="""Attaches the containers to the specified docker network.
         For use when the proxy, tmpnb, and containers are all in docker."""
     )
+    tornado.options.define('isolated_networks', default=0,
+        help=dedent("""
+        Give every container a bridge network of its own, keeping this many
+        networks created ahead of time so that launches don't wait on them.
+        Networks are reused once their containers are removed. Overrides
+        docker_network. Disabled by default (0).""")
+    )
+    tornado.options.define('isolated_network_internal', default=False,
+        help="Create isolated networks as internal networks, with no outside access."
+    )
+    tornado.options.define('isolated_network_attach', default=[], multiple=True,
+        help=dedent("""
+        Containers to connect to every isolated network, such as the proxy when it
+        runs in docker, as a comma-delimited list of names.""")
+    )
     tornado.options.define('host_directories', default=None,
         help=dedent("""
         Mount the specified directory as a data volume in a specified location
@@ -383,7 +707,9 @@ default docker bridge. Affects the semantics of container_port and container_ip.
 
     handlers = [
         (r"/api/spawn/?", APISpawnHandler),
+        (r"/api/spawn/(\w+)/?", APISpawnJobHandler),
         (r"/api/stats/?", APIStatsHandler),
+        (r"/api/ready/?", APIReadyHandler),
         (r"/stats/?", RedirectHandler, {"url": "/api/stats"}),
     ]
 
@@ -399,7 +725,9 @@ default docker bridge. Affects the semantics of container_port and container_ip.
         ])
 
     admin_handlers = [
-        (r"/api/pool/?", APIPoolHandler)
+        (r"/api/pool/?", APIPoolHandler),
+        (r"/api/pool/upgrade/?", APIPoolUpgradeHandler),
+        (r"/api/pool/quarantine/?", APIQuarantineHandler),
     ]
 
     max_idle = datetime.timedelta(seconds=opts.cull_timeout)
@@ -429,17 +757,65 @@ default docker bridge. Affects the semantics of container_port and container_ip.
     spawner = dockworker.DockerSpawner(docker_host,
                                        timeout=30,
                                        version=opts.docker_version,
-                                       max_workers=opts.max_dock_workers,
+                                       max_connections=opts.max_dock_workers,
                                        assert_hostname=opts.assert_hostname,
+                                       concurrency=dict((name, int(limit)) for name, limit in
+                                           (item.split('=') for item in opts.docker_concurrency)),
+                                       cpuset_size=opts.cpuset_size,
+                                       port_range=(tuple(int(port) for port in opts.port_range.split('-'))
+                                                   if opts.port_range else None),
     )
 
     static_path = os.path.join(os.path.dirname(__file__), "static")
 
+    networks = None
+    if opts.isolated_networks:
+        networks = spawnpool.NetworkPool(spawner,
+                                         prefix='tmp.{}.net'.format(pool_name),
+                                         size=opts.isolated_networks,
+                                         internal=opts.isolated_network_internal,
+                                         labels={dockworker.POOL_LABEL: pool_name},
+                                         attach=opts.isolated_network_attach)
+
+    images = spawnpool.ImageManager(spawner, opts.image)
+
+    probe = spawnpool.ReadinessProbe(
+        endpoint=opts.probe_endpoint or spawnpool.probe_endpoint(opts.command),
+        timeout=opts.boot_timeout)
+
+    if opts.warmup_script:
+        images = spawnpool.ImageBaker(images, spawner, container_config, opts.warmup_script,
+                                      opts.warm_repository or 'tmpnb-warm/{}'.format(
+                                          pool_name.lower()),
+                                      probe=probe,
+                                      pool_name=pool_name,
+                                      timeout=opts.warmup_timeout)
+
     pool = spawnpool.SpawnPool(proxy_endpoint=proxy_endpoint,
                                proxy_token=proxy_token,
                                spawner=spawner,
                                container_config=container_config,
                                capacity=opts.pool_size,
+                               max_capacity=opts.pool_max,
+                               created_capacity=opts.created_pool_size,
+                               pause_pooled=opts.pause_pooled,
+                               pooled_mem_limit=opts.pooled_mem_limit,
+                               launcher=spawnpool.LaunchScheduler(
+                                   concurrency=opts.launch_concurrency,
+                                   rate=opts.launch_rate),
+                               reaper=spawnpool.Reaper(
+                                   batch_size=opts.reap_batch_size,
+                                   interval=opts.reap_interval),
+                               networks=networks,
+                               images=images,
+                               upgrade_surge=opts.upgrade_surge,
+                               probe=probe,
+                               quarantine_size=opts.quarantine_size,
+                               failure_threshold=opts.image_failure_threshold,
+                               failure_pause=opts.image_failure_pause,
+                               store=poolstore.PoolStore(opts.state_db) if opts.state_db else None,
+                               low_water=opts.pool_low_water,
+                               high_water=opts.pool_high_water,
                                max_idle=max_idle,
                                max_age=max_age,
                                static_files=opts.static_files,
@@ -457,6 +833,7 @@ default docker bridge. Affects the semantics of container_port and container_ip.
         xsrf_cookies=False,
         debug=True,
         cull_period=opts.cull_period,
+        spawn_timeout=opts.spawn_timeout,
         allow_origin=opts.allow_origin,
         expose_headers=opts.expose_headers,
         max_age=opts.max_age,
@@ -479,38 +856,67 @@ default docker bridge. Affects the semantics of container_port and container_ip.
         admin_token=admin_token
     )
 
-    # Cleanup on a fresh state (likely a restart)
-    ioloop.run_sync(pool.cleanout)
-
-    # Synchronously cull any existing, inactive containers, and pre-launch a set number of
-    # containers, ready to serve.
-    ioloop.run_sync(pool.heartbeat)
-
-    if(opts.static_files):
-        ioloop.run_sync(pool.copy_static)
-
-    # Periodically execute a heartbeat function to cull used containers and regenerated failed
-    # ones, self-healing the cluster.
-    cull_ms = opts.cull_period * 1e3
-    app_log.info("Culling containers unused for %i seconds every %i seconds.",
-                 opts.cull_timeout,
-                 opts.cull_period)
-    culler = tornado.ioloop.PeriodicCallback(pool.heartbeat, cull_ms)
-    culler.start()
+    # Bind the listeners first, so that the node answers (and reports that it is warming up) at
+    # once. The first inherited socket serves users and the second the admin API.
+    sockets = inherited_sockets() + [None, None]
 
     app_log.info("Listening on {}:{}".format(opts.ip or '*', opts.port))
     app_log.info('handlers %s', handlers)
 
     application = tornado.web.Application(handlers, **settings)
     http_server = HTTPServer(application, xheaders=True)
-    http_server.listen(opts.port, opts.ip)
+    listen(http_server, sockets[0], opts.port, opts.ip)
 
     app_log.info("Admin listening on {}:{}".format(opts.admin_ip or '*', opts.admin_port))
     admin_application = tornado.web.Application(admin_handlers, **admin_settings)
     admin_server = HTTPServer(admin_application, xheaders=True)
-    admin_server.listen(opts.admin_port, opts.admin_ip)
+    listen(admin_server, sockets[1], opts.admin_port, opts.admin_ip)
 
+    @gen.coroutine
+    def warm_up():
+        # Roll the pool over to each new image, including a warm image that finishes baking
+        # while the pool is still starting.
+        images.on_change(lambda old, new: pool.upgrade())
+
+        # Pin the image, take back the containers left by the previous run, and clean up the
+        # rest. The pool then fills in the background, serving containers as they come up.
+        yield pool.start(opts.cleanout_concurrency)
+
+        # Periodically execute a heartbeat function to cull used containers and regenerated
+        # failed ones, self-healing the cluster.
+        cull_ms = opts.cull_period * 1e3
+        app_log.info("Culling containers unused for %i seconds every %i seconds.",
+                     opts.cull_timeout,
+                     opts.cull_period)
+        culler = tornado.ioloop.PeriodicCallback(pool.heartbeat, cull_ms)
+        culler.start()
+
+        # Replace containers as soon as Docker reports that they died.
+        ioloop.spawn_callback(pool.watch)
+
+        # Catch containers that exited or vanished behind the pool's back.
+        reconciler = tornado.ioloop.PeriodicCallback(pool.reconcile,
+                                                     opts.reconcile_period * 1e3)
+        reconciler.start()
+
+        # Follow the image tag, pulling new images in the background.
+        if opts.image_check_period:
+            image_checker = tornado.ioloop.PeriodicCallback(images.refresh,
+                                                            opts.image_check_period * 1e3)
+            image_checker.start()
+
+        if(opts.static_files):
+            yield pool.copy_static()
+
+    def warmed_up(future):
+        if future.exception() is not None:
+            ioloop.stop()
+
+    warming = warm_up()
+    ioloop.add_future(warming, warmed_up)
     ioloop.start()
+    # The loop only stops if the pool could not be started; report why.
+    warming.result()
 
 if __name__ == "__main__":
     main()
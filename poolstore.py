@@ -0,0 +1,87 @@
+import json
+import sqlite3
+from datetime import datetime
+
+from tornado.log import app_log
+
+_date_fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# Attributes of a PooledContainer that are kept, in column order.
+FIELDS = ('id', 'name', 'path', 'token', 'state', 'labels', 'container_port', 'host_ip',
+          'host_port', 'mem_limit', 'network', 'created', 'acquired')
+
+
+class PoolStore():
+    '''Keep a record of a pool's containers in a SQLite database, so that an orchestrator that
+    restarts can adopt the containers it left running instead of starting from scratch.
+
+    Every change is written as it happens. The database runs in WAL mode without syncing each
+    write, which keeps a write well under a millisecond on the IOLoop; at worst a crash loses
+    the last few changes, which adoption checks against Docker anyway.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS containers ({})'.format(
+            ', '.join(field + (' TEXT PRIMARY KEY' if field == 'id' else '')
+                      for field in FIELDS)))
+        self._insert = 'INSERT OR REPLACE INTO containers ({}) VALUES ({})'.format(
+            ', '.join(FIELDS), ', '.join('?' for field in FIELDS))
+
+    def save(self, container):
+        '''Record the current state of a container that Docker has given an id.'''
+
+        if container.id is None:
+            return
+        self._db.execute(self._insert, [_encode(field, getattr(container, field))
+                                        for field in FIELDS])
+
+    def delete(self, container):
+        if container.id is None:
+            return
+        self._db.execute('DELETE FROM containers WHERE id = ?', (container.id,))
+
+    def load(self):
+        '''Return every recorded container as a dict of its attributes.'''
+
+        cursor = self._db.execute('SELECT {} FROM containers'.format(', '.join(FIELDS)))
+        records = [dict((field, _decode(field, value)) for field, value in zip(FIELDS, row))
+                   for row in cursor]
+        app_log.info("Loaded [%i] containers from [%s].", len(records), self.path)
+        return records
+
+    def forget(self, ids):
+        '''Delete the records of the containers with `ids`, in a single transaction.'''
+
+        self._db.execute('BEGIN')
+        try:
+            self._db.executemany('DELETE FROM containers WHERE id = ?', [(id,) for id in ids])
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def close(self):
+        self._db.close()
+
+
+def _encode(field, value):
+    if value is None:
+        return None
+    if field == 'labels':
+        return json.dumps(value)
+    if field in ('created', 'acquired'):
+        return value.strftime(_date_fmt)
+    return value
+
+
+def _decode(field, value):
+    if value is None:
+        return None
+    if field == 'labels':
+        return json.loads(value)
+    if field in ('created', 'acquired'):
+        return datetime.strptime(value, _date_fmt)
+    return value
@@ -1,22 +1,26 @@
-import errno
+import hashlib
 import json
 import os
 import random
 import string
-import socket
+import sys
 
 from concurrent.futures import ThreadPoolExecutor
-from collections import deque, namedtuple
+from collections import deque, namedtuple, OrderedDict
 from datetime import datetime, timedelta
 from tornado import gen
 from tornado import ioloop
+from tornado.concurrent import Future
+from tornado.locks import Condition, Event, Semaphore
 from tornado.log import app_log
+from tornado.tcpclient import TCPClient
 from tornado.httpclient import HTTPRequest, HTTPError, AsyncHTTPClient
 from tornado.httputil import url_concat
 
 import pytz
 import re
 import dockworker
+from docker.utils import parse_repository_tag
 
 AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
 import logging
@@ -35,21 +39,950 @@ def new_user(size):
     return sample_with_replacement(string.ascii_letters + string.digits, size)
 
 
+# Lifecycle states of a container owned by the pool. Created containers exist but have not been
+# started yet; they are held in reserve to make refills faster.
+CREATED = 'created'
+CREATING = 'creating'
+BOOTING = 'booting'
+POOLED = 'pooled'
+ASSIGNED = 'assigned'
+RELEASING = 'releasing'
+DEAD = 'dead'
+
+STATES = (CREATED, CREATING, BOOTING, POOLED, ASSIGNED, RELEASING, DEAD)
+# Phases a pool goes through after startup: taking over from the previous run, filling, and
+# filled for the first time. A warming pool already serves whatever containers it has.
+STARTING = 'starting'
+WARMING = 'warming'
+READY = 'ready'
+
+# Stages of a launch, each of which must succeed before a container joins the pool.
+LAUNCH_STAGES = ('create', 'start', 'boot', 'route')
+# States of containers that count against the pool's capacity.
+LIVE_STATES = (CREATING, BOOTING, POOLED, ASSIGNED)
+
+
 class PooledContainer(object):
-    def __init__(self, id, path, token=''):
+    '''Record of a single container owned by the pool.
+
+    The id is None while the container is still being created.'''
+
+    def __init__(self, id, path, token='', name=None, state=CREATING, labels=None):
         self.id = id
         self.path = path
         self.token = token
+        self.name = name
+        self.state = state
+        self.labels = labels or {}
+        self.paused = False
+        self.freezing = None
+        self.mem_limit = None
+        self.network = None
+        self.container_port = None
+        self.host_ip = None
+        self.host_port = None
+        self.created = datetime.utcnow()
+        self.updated = self.created
+        self.acquired = None
 
     def __repr__(self):
         return 'PooledContainer(id=%s, path=%s)' % (self.id, self.path)
 
+
+class ContainerRegistry(object):
+    '''Authoritative in-process record of every container owned by a pool, indexed by id, by path
+    and by lifecycle state.
+
+    Containers within a state are kept in the order they entered it. If a `store` is given,
+    every change is also written to it, so the registry can be restored after a restart.'''
+
+    def __init__(self, store=None):
+        self.store = store
+        self._by_id = {}
+        self._by_path = {}
+        self._by_state = dict((state, OrderedDict()) for state in STATES)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __contains__(self, container):
+        return container in self._by_state[container.state]
+
+    def add(self, container):
+        if container.id is not None:
+            self._by_id[container.id] = container
+        self._by_path[container.path] = container
+        self._by_state[container.state][container] = None
+        self.save(container)
+
+    def identify(self, container, id):
+        '''Record the Docker id of a container that has just been created.'''
+
+        container.id = id
+        self._by_id[id] = container
+        self.save(container)
+
+    def remove(self, container):
+        if self._by_id.get(container.id) is container:
+            del self._by_id[container.id]
+        if self._by_path.get(container.path) is container:
+            del self._by_path[container.path]
+        self._by_state[container.state].pop(container, None)
+        if self.store is not None:
+            self.store.delete(container)
+
+    def transition(self, container, state):
+        '''Move a container into a new lifecycle state.'''
+
+        self._by_state[container.state].pop(container, None)
+        container.state = state
+        container.updated = datetime.utcnow()
+        self._by_state[state][container] = None
+        self.save(container)
+
+    def save(self, container):
+        '''Write a container to the store, if there is one. Changes made by transitions are saved
+        already; this is for attributes changed in place.'''
+
+        if self.store is not None:
+            self.store.save(container)
+
+    def get(self, id):
+        return self._by_id.get(id)
+
+    def by_path(self, path):
+        return self._by_path.get(path)
+
+    def in_state(self, *states):
+        '''List the containers in any of the given states, oldest first within each state.'''
+
+        return [container for state in states for container in self._by_state[state]]
+
+    def newest(self, state):
+        '''Return the container that most recently entered a state, or None.'''
+
+        containers = self._by_state[state]
+        if not containers:
+            return None
+        return next(reversed(containers))
+
+    def count(self, *states):
+        return sum(len(self._by_state[state]) for state in states)
+
+    def counts(self):
+        return dict((state, len(containers)) for state, containers in self._by_state.items())
+
 class EmptyPoolError(Exception):
     '''Exception raised when a container is requested from an empty pool.'''
 
     pass
 
 
+class LaunchError(Exception):
+    '''Exception raised when a container could not be launched, naming the stage that failed:
+    create, start, boot, or route.'''
+
+    def __init__(self, stage, error):
+        super(LaunchError, self).__init__("Unable to {} container: {}".format(stage, error))
+        self.stage = stage
+        self.error = error
+
+
+class SpawnJob(object):
+    '''A queued request for a container, identified by an opaque id so that API clients can poll
+    for it after receiving a 202.'''
+
+    def __init__(self, id, future):
+        self.id = id
+        self.future = future
+        self.created = datetime.utcnow()
+
+    @property
+    def status(self):
+        if not self.future.done():
+            return 'pending'
+        if self.future.exception() is not None:
+            return 'full'
+        return 'ready'
+
+    @property
+    def container(self):
+        return self.future.result()
+
+    def __repr__(self):
+        return 'SpawnJob(id=%s, status=%s)' % (self.id, self.status)
+
+
+class LaunchScheduler():
+    '''Run container launches through a bounded number of workers at a limited rate.
+
+    Launches wait in one of three lanes: urgent launches, made for requests that are waiting on a
+    container, always start ahead of background refills, which in turn go ahead of low priority
+    work such as topping up the tier of created containers.'''
+
+    URGENT = 'urgent'
+    BACKGROUND = 'background'
+    LOW = 'low'
+    PRIORITIES = (URGENT, BACKGROUND, LOW)
+
+    def __init__(self, concurrency=4, rate=None):
+        self.concurrency = max(1, concurrency)
+        self.interval = 1.0 / rate if rate else 0
+        self.running = 0
+
+        self._lanes = dict((priority, deque()) for priority in self.PRIORITIES)
+        self._wakeup = Condition()
+        self._next_start = 0
+        self._workers = 0
+
+    @property
+    def queued(self):
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def submit(self, fn, priority=BACKGROUND):
+        '''Queue a coroutine function to be called once a launch slot is free. Returns a Future
+        resolving to its result.'''
+
+        future = Future()
+        self._lanes[priority].append((fn, future))
+        while self._workers < self.concurrency:
+            self._workers += 1
+            ioloop.IOLoop.current().spawn_callback(self._work)
+        self._wakeup.notify()
+        return future
+
+    def promote(self, count=1):
+        '''Move up to `count` of the oldest background launches into the urgent lane.'''
+
+        background = self._lanes[self.BACKGROUND]
+        urgent = self._lanes[self.URGENT]
+        for i in range(min(count, len(background))):
+            urgent.append(background.popleft())
+
+    def _next(self):
+        for priority in self.PRIORITIES:
+            if self._lanes[priority]:
+                return self._lanes[priority].popleft()
+
+    @gen.coroutine
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                yield self._wakeup.wait()
+                continue
+            fn, future = item
+            self.running += 1
+            try:
+                yield self._throttle()
+                result = yield fn()
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(result)
+            finally:
+                self.running -= 1
+
+    @gen.coroutine
+    def _throttle(self):
+        '''Space out the start of launches to respect the configured rate.'''
+
+        if not self.interval:
+            return
+        now = ioloop.IOLoop.current().time()
+        start = max(now, self._next_start)
+        self._next_start = start + self.interval
+        if start > now:
+            yield gen.sleep(start - now)
+
+
+class Reaper():
+    '''Tear down released containers in the background.
+
+    Containers are killed and removed in batches of at most `batch_size`, at most one batch every
+    `interval` seconds, so that a mass cull doesn't flood the Docker daemon. Failed removals are
+    retried up to `max_attempts` times in all before being abandoned.'''
+
+    def __init__(self, batch_size=10, interval=1.0, max_attempts=3):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self._queue = deque()
+        self._running = False
+        self._destroy = None
+        self._abandon = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def bind(self, destroy, abandon):
+        '''Set the coroutine function that destroys a container, and the function called with
+        a container and its last error once it has been given up on.'''
+
+        self._destroy = destroy
+        self._abandon = abandon
+
+    def enqueue(self, container):
+        self._queue.append((container, 0))
+        if not self._running:
+            self._running = True
+            ioloop.IOLoop.current().spawn_callback(self._run)
+
+    @gen.coroutine
+    def _run(self):
+        try:
+            while self._queue:
+                count = min(self.batch_size, len(self._queue))
+                batch = [self._queue.popleft() for i in range(count)]
+                app_log.debug("Reaping [%i] containers (%i more queued).", count, len(self._queue))
+                yield [self._reap(container, attempts) for container, attempts in batch]
+                if self._queue:
+                    yield gen.sleep(self.interval)
+        finally:
+            self._running = False
+
+    @gen.coroutine
+    def _reap(self, container, attempts):
+        try:
+            yield self._destroy(container)
+        except Exception as e:
+            if attempts + 1 < self.max_attempts:
+                app_log.warning("Unable to remove container [%s], will retry: %s", container, e)
+                self._queue.append((container, attempts + 1))
+            else:
+                self._abandon(container, e)
+
+
+# Readiness endpoints for the servers containers may run, matched against the container command
+# and relative to the container's base path.
+PROBE_ENDPOINTS = (
+    ('kernelgateway', 'api/kernelspecs'),
+    ('KernelGatewayApp', 'api/kernelspecs'),
+    ('notebook', 'api'),
+)
+
+
+def probe_endpoint(command):
+    '''The readiness endpoint for the server `command` runs, defaulting to the notebook's.'''
+
+    for marker, endpoint in PROBE_ENDPOINTS:
+        if marker in (command or ''):
+            return endpoint
+    return 'api'
+
+
+class ReadinessProbe():
+    '''Wait, without blocking, for the servers in new containers to answer.
+
+    A probe first connects to the container's port, then polls `endpoint` under its base path
+    until it answers successfully. Probes back off from `min_interval` up to `max_interval`,
+    adjusted to the boot times recently measured for the same image: the first probe is held
+    back until the fastest boots have been seen to finish, and the interval grows with the
+    typical boot time. Every probe is a coroutine on the IOLoop, so any number of containers can
+    be waited on at once.'''
+
+    def __init__(self, endpoint='api', timeout=30, min_interval=0.05, max_interval=1.0,
+                 history=100):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.history = history
+        self.active = 0
+        self.booted = 0
+        self.failed = 0
+        # Recent boot times, in seconds, for each image.
+        self._boot_times = {}
+
+    @gen.coroutine
+    def wait(self, ip, port, path, image=None, token='', alive=None):
+        '''Wait for the server at `ip`:`port` to answer under `path`.
+
+        Raises an exception if it doesn't within the timeout, or as soon as `alive()`, when
+        given, returns False.'''
+
+        loop = ioloop.IOLoop.current()
+        start = loop.time()
+        deadline = start + self.timeout
+        url = "http://{}:{}{}{}".format(ip, port, path, self.endpoint)
+        headers = {'Authorization': 'token {}'.format(token)} if token else None
+        first, interval, cap = self._schedule(image)
+
+        self.active += 1
+        try:
+            if first:
+                yield gen.sleep(min(first, self.timeout))
+            connected = False
+            while True:
+                if alive is not None and not alive():
+                    raise Exception("Server at [{}:{}] stopped while booting.".format(ip, port))
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise Exception("Server at [{}:{}] did not become ready within {}s.".format(
+                        ip, port, self.timeout))
+                # Docker starts listening on a socket before the container is fully launched, so
+                # the port accepting a connection doesn't mean the server is up; it only tells us
+                # when an HTTP probe is worth sending.
+                if not connected:
+                    connected = yield self._connect(ip, port, min(remaining, 1.0))
+                if connected and (yield self._ready(url, headers, min(remaining, 2.0))):
+                    break
+                yield gen.sleep(min(interval, max(0, deadline - loop.time())))
+                interval = min(cap, interval * 1.5)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.active -= 1
+
+        elapsed = loop.time() - start
+        self.booted += 1
+        times = self._boot_times.setdefault(image, deque(maxlen=self.history))
+        times.append(elapsed)
+        app_log.info("Server [%s] at address [%s:%s] has booted in %.2fs! Have at it.",
+                     path, ip, port, elapsed)
+
+    @gen.coroutine
+    def check(self, ip, port, path, token=''):
+        '''Probe a server that should already be up once. Returns whether it answered.'''
+
+        url = "http://{}:{}{}{}".format(ip, port, path, self.endpoint)
+        headers = {'Authorization': 'token {}'.format(token)} if token else None
+        ready = yield self._ready(url, headers, 2.0)
+        raise gen.Return(ready)
+
+    def _schedule(self, image):
+        '''The initial delay, first interval, and largest interval for probing a new container
+        of `image`.'''
+
+        times = sorted(self._boot_times.get(image) or ())
+        if not times:
+            return 0, self.min_interval, min(self.max_interval, 0.2)
+        fastest = _percentile(times, 0.1)
+        typical = _percentile(times, 0.5)
+        cap = max(self.min_interval, min(self.max_interval, typical / 10))
+        return fastest * 0.8, self.min_interval, cap
+
+    @gen.coroutine
+    def _connect(self, ip, port, timeout):
+        try:
+            stream = yield gen.with_timeout(timedelta(seconds=timeout),
+                                            TCPClient().connect(ip, port))
+        except Exception as e:
+            app_log.debug("Unable to connect to [%s:%s] yet: %s", ip, port, e)
+            raise gen.Return(False)
+        stream.close()
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def _ready(self, url, headers, timeout):
+        request = HTTPRequest(url, headers=headers, follow_redirects=False,
+                              connect_timeout=timeout, request_timeout=timeout)
+        try:
+            yield AsyncHTTPClient().fetch(request)
+        except HTTPError as e:
+            app_log.debug("Booting server at [%s], getting HTTP status [%s]", url, e.code)
+            raise gen.Return(False)
+        except Exception as e:
+            app_log.debug("Booting server at [%s]: %s", url, e)
+            raise gen.Return(False)
+        raise gen.Return(True)
+
+    def stats(self):
+        '''Boot time percentiles, in seconds, for each image, plus probe counts.'''
+
+        images = {}
+        for image, times in self._boot_times.items():
+            ordered = sorted(times)
+            images[image or 'unknown'] = {
+                'count': len(ordered),
+                'p50': _percentile(ordered, 0.5),
+                'p90': _percentile(ordered, 0.9),
+                'p99': _percentile(ordered, 0.99),
+                'max': ordered[-1],
+            }
+        return {
+            'active': self.active,
+            'booted': self.booted,
+            'failed': self.failed,
+            'boot_times': images,
+        }
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class NetworkPool():
+    '''Keep `size` isolated networks created ahead of time, so that each container can have a
+    network of its own without waiting on Docker to create one.
+
+    Networks are bridges, without egress if `internal`, tagged with `labels`, and have the
+    containers in `attach` (such as the proxy) connected to them. A network goes back into the
+    pool once its container has been removed, and the pool is topped up in the background.'''
+
+    def __init__(self, spawner, prefix, size, internal=False, labels=None, attach=()):
+        self.spawner = spawner
+        self.prefix = prefix
+        self.size = size
+        self.internal = internal
+        self.labels = labels or {}
+        self.attach = tuple(attach)
+        self._free = deque()
+        self._creating = 0
+        self._refilling = False
+
+    def __len__(self):
+        return len(self._free)
+
+    @gen.coroutine
+    def adopt(self, in_use=()):
+        '''Take back the unused networks left over from a previous run, leaving out those
+        `in_use` by adopted containers.
+
+        Listing networks doesn't say which containers are connected to them (newer daemons leave
+        it out), so each network is inspected to find any that are still occupied.'''
+
+        networks = yield self.spawner.list_networks(self.labels)
+        infos = yield [self.spawner.inspect_network(network['Name']) for network in networks
+                       if network['Name'] not in in_use]
+        for info in infos:
+            if info is not None and len(info.get('Containers') or {}) <= len(self.attach):
+                self._free.append(info['Name'])
+        app_log.info("Adopted [%i] networks.", len(self._free))
+        self._maybe_refill()
+
+    @gen.coroutine
+    def take(self):
+        '''Hand out a network, creating one on the spot if none are ready.'''
+
+        if self._free:
+            name = self._free.popleft()
+        else:
+            app_log.warning("No isolated networks are ready; creating one on demand.")
+            name = yield self._create()
+        self._maybe_refill()
+        raise gen.Return(name)
+
+    def recycle(self, name):
+        '''Return a network whose container has been removed.'''
+
+        if name is None:
+            return
+        if len(self._free) + self._creating < self.size:
+            self._free.append(name)
+        else:
+            ioloop.IOLoop.current().spawn_callback(self._remove, name)
+
+    @gen.coroutine
+    def _create(self):
+        name = '{}.{}'.format(self.prefix, new_user(12))
+        yield self.spawner.create_network(name, internal=self.internal, labels=self.labels,
+                                          attach=self.attach)
+        raise gen.Return(name)
+
+    @gen.coroutine
+    def _remove(self, name):
+        try:
+            yield self.spawner.remove_network(name)
+        except Exception as e:
+            app_log.error("Unable to remove network [%s]: %s", name, e)
+
+    def _maybe_refill(self):
+        if not self._refilling and len(self._free) < self.size:
+            self._refilling = True
+            ioloop.IOLoop.current().spawn_callback(self._refill)
+
+    @gen.coroutine
+    def _refill(self):
+        try:
+            while len(self._free) + self._creating < self.size:
+                self._creating += 1
+                try:
+                    name = yield self._create()
+                except Exception as e:
+                    app_log.error("Unable to create an isolated network: %s", e)
+                    break
+                finally:
+                    self._creating -= 1
+                self._free.append(name)
+        finally:
+            self._refilling = False
+
+
+class ImageManager():
+    '''Pin the pool's image to the exact image its tag points to, and follow the tag.
+
+    The tag is resolved when the manager starts, pulling the image if it isn't on the host yet,
+    and again on every update. When the tag has moved, the new image is pulled by digest and only
+    pinned once the pull has finished, so every container is created from a complete, known image.
+    An image given by digest is simply pinned.'''
+
+    def __init__(self, spawner, image):
+        self.spawner = spawner
+        self.image = image
+        self.repository, tag = parse_repository_tag(image)
+        self.fixed = '@' in image
+        self.tag = tag or 'latest'
+        # The pinned image and the one being pulled to replace it, as {'digest', 'id'}.
+        self.current = None
+        self.next = None
+        self.progress = None
+        self._listeners = []
+        self._updating = None
+
+    @property
+    def pinned(self):
+        '''The reference containers are created from.'''
+
+        if self.current is None:
+            return self.image
+        return self.current['id']
+
+    def on_change(self, callback):
+        '''Call `callback(old, new)` whenever a new image is pinned.'''
+
+        self._listeners.append(callback)
+
+    @gen.coroutine
+    def start(self):
+        '''Pin the image the tag points to now, pulling it first if it isn't on this host.'''
+
+        info = yield self.spawner.inspect_image(self.image)
+        if info is None:
+            app_log.info("Image [%s] is not on this host; pulling it.", self.image)
+            yield self._pull(self.repository, self.tag)
+            info = yield self.spawner.inspect_image(self.image)
+            if info is None:
+                raise Exception("Image [{}] is still missing after pulling it.".format(
+                    self.image))
+        self.current = self._describe(info)
+        app_log.info("Pinned image [%s] to [%s].", self.image, self.current['id'])
+
+    @gen.coroutine
+    def refresh(self):
+        '''Follow the tag in the background, logging rather than propagating any failure.'''
+
+        try:
+            yield self.update()
+        except Exception as e:
+            app_log.error("Unable to update image [%s]: %s", self.image, e)
+
+    @gen.coroutine
+    def update(self):
+        '''Check whether the tag has moved, and if so pull the image it now points to and pin it.
+
+        Returns whether a new image was pinned. Concurrent callers share a single update.'''
+
+        if self.fixed or self.current is None:
+            raise gen.Return(False)
+        updating = self._updating
+        if updating is None:
+            updating = self._updating = self._update()
+            updating.add_done_callback(self._updated)
+        changed = yield updating
+        raise gen.Return(changed)
+
+    def _updated(self, future):
+        self._updating = None
+
+    @gen.coroutine
+    def _update(self):
+        digest = yield self.spawner.remote_digest(self.image)
+        if digest is None:
+            # There's no registry to ask, so follow the tag on this host.
+            info = yield self.spawner.inspect_image(self.image)
+            if info is None or info['Id'] == self.current['id']:
+                raise gen.Return(False)
+            self._promote(self._describe(info))
+            raise gen.Return(True)
+        if digest == self.current['digest']:
+            raise gen.Return(False)
+
+        app_log.info("Image [%s] has moved to [%s]; pulling it.", self.image, digest)
+        reference = '{}@{}'.format(self.repository, digest)
+        self.next = {'digest': digest, 'id': None}
+        try:
+            info = yield self.spawner.inspect_image(reference)
+            if info is None:
+                yield self._pull(self.repository, digest)
+                info = yield self.spawner.inspect_image(reference)
+            if info is None:
+                raise Exception("Image [{}] is still missing after pulling it.".format(reference))
+        finally:
+            self.next = None
+        self._promote(self._describe(info, digest))
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def _pull(self, repository, tag):
+        layers = {}
+        self.progress = {'image': '{}:{}'.format(repository, tag), 'status': None,
+                         'downloaded': 0, 'total': 0}
+        logged = [0]
+
+        def report(document):
+            detail = document.get('progressDetail') or {}
+            if document.get('id') and detail.get('total'):
+                layers[document['id']] = (detail.get('current', 0), detail['total'])
+            self.progress['status'] = document.get('status')
+            self.progress['downloaded'] = sum(current for current, total in layers.values())
+            self.progress['total'] = sum(total for current, total in layers.values())
+            if self.progress['total']:
+                percent = 100 * self.progress['downloaded'] // self.progress['total']
+                if percent >= logged[0] + 10:
+                    logged[0] = percent
+                    app_log.info("Pulling [%s]: %i%%", self.progress['image'], percent)
+
+        try:
+            yield self.spawner.pull_image(repository, tag, progress=report)
+        finally:
+            self.progress = None
+
+    def _describe(self, info, digest=None):
+        if digest is None:
+            prefix = self.repository + '@'
+            digests = [reference.split('@', 1)[1] for reference in info.get('RepoDigests') or []
+                       if reference.startswith(prefix)]
+            digest = digests[0] if digests else None
+        return {'digest': digest, 'id': info['Id']}
+
+    def _promote(self, image):
+        old, self.current = self.current, image
+        app_log.info("Pinned image [%s] to [%s] (was [%s]).", self.image, image['id'], old['id'])
+        for callback in self._listeners:
+            callback(old, image)
+
+    def stats(self):
+        return {
+            'image': self.image,
+            'current': self.current,
+            'next': self.next,
+            'pull': self.progress,
+        }
+
+
+# Removes a server's Jupyter runtime files: its cookie secret, and the server info file holding
+# its token.
+CLEAR_RUNTIME = 'runtime="$(jupyter --runtime-dir)" && rm -rf "$runtime"'
+
+
+class ImageBaker():
+    '''Build the pool's containers from a warm image: the source image pinned by an
+    ImageManager, booted once and warmed up by `script`, then committed.
+
+    A template container is launched from the source image and, once its server answers, `script`
+    is run in it with `sh -c`, so that whatever it imports, compiles or caches is already on disk
+    when pool containers start. The result is committed as `repository`:<source digest>, and
+    reused for as long as the source image and the script stay the same; a change to either bakes
+    a new one. Docker copies a container's labels into the image committed from it, so the
+    template's own label is blanked in the image; otherwise every pool container would carry it,
+    and be removed as a leftover template on the next start.
+
+    The template's server is still running when it is committed, so its Jupyter runtime directory
+    is cleared first. Left in place, every pool container would share the template's cookie
+    secret, and any user could sign login cookies that other users' servers accept.
+
+    Baking happens in the background: containers are built from the source image meanwhile, and
+    the warm image is announced to on_change listeners once it is ready. If baking fails,
+    containers go on being built from the source image, and the same source and script are not
+    baked again.
+
+    Stands in for the ImageManager it wraps, so the pool treats it the same way.'''
+
+    def __init__(self, source, spawner, container_config, script, repository, probe, pool_name,
+                 timeout=600):
+        self.source = source
+        self.spawner = spawner
+        self.container_config = container_config
+        self.script = script
+        self.repository = repository
+        self.probe = probe
+        self.timeout = timeout
+        self.labels = {dockworker.BAKE_LABEL: pool_name}
+        self.script_hash = hashlib.sha1(script.encode('utf-8')).hexdigest()
+        # The warm image in use, as {'id', 'reference', 'source'}, or None to use the source.
+        self.current = None
+        self.baking = None
+        # The (source id, script hash) that last failed to bake.
+        self._failed = None
+        self._listeners = []
+        self._updating = None
+
+    @property
+    def pinned(self):
+        if self.current is None:
+            return self.source.pinned
+        return self.current['id']
+
+    def on_change(self, callback):
+        '''Call `callback(old, new)` whenever the image containers are built from changes.'''
+
+        self._listeners.append(callback)
+
+    @gen.coroutine
+    def start(self):
+        '''Pin the source image, clear out template containers left by a previous run, and use
+        the warm image already baked for the source, if any. Otherwise one is baked in the
+        background, so that the pool can start filling from the source image right away.'''
+
+        yield self.source.start()
+        leftovers = yield self.spawner.list_notebook_servers(self.labels, all=True)
+        for info in leftovers:
+            yield self._discard(info['Id'])
+        self.current = yield self._find(self.source.current)
+        if self.current is None:
+            ioloop.IOLoop.current().spawn_callback(self.refresh)
+
+    @gen.coroutine
+    def refresh(self):
+        '''Follow the source image in the background, logging rather than propagating any
+        failure.'''
+
+        try:
+            yield self.update()
+        except Exception as e:
+            app_log.error("Unable to update warm image [%s]: %s", self.repository, e)
+
+    @gen.coroutine
+    def update(self):
+        '''Follow the source image, baking a warm image for it if needed. Returns whether the
+        image containers are built from changed. Concurrent callers share a single update.'''
+
+        updating = self._updating
+        if updating is None:
+            updating = self._updating = self._update()
+            updating.add_done_callback(self._updated)
+        changed = yield updating
+        raise gen.Return(changed)
+
+    def _updated(self, future):
+        self._updating = None
+
+    @gen.coroutine
+    def _update(self):
+        yield self.source.update()
+        source = self.source.current
+        if self.current is not None and self.current['source'] == source['id']:
+            raise gen.Return(False)
+
+        warm = yield self._find(source)
+        if warm is None:
+            if self._failed == (source['id'], self.script_hash):
+                # Baking it again would only fail again.
+                raise gen.Return(self._promote(None))
+            tag = self._tag(source)
+            try:
+                image_id = yield self._bake(source['id'], tag)
+            except Exception as e:
+                self._failed = (source['id'], self.script_hash)
+                app_log.error("Unable to bake warm image [%s:%s]; using image [%s] as it is: %s",
+                              self.repository, tag, source['id'], e)
+                raise gen.Return(self._promote(None))
+            warm = {'id': image_id, 'reference': '{}:{}'.format(self.repository, tag),
+                    'source': source['id']}
+        raise gen.Return(self._promote(warm))
+
+    def _tag(self, source):
+        return (source['digest'] or source['id']).split(':')[-1][:12]
+
+    @gen.coroutine
+    def _find(self, source):
+        '''The warm image already baked from `source` with the current script, or None.'''
+
+        reference = '{}:{}'.format(self.repository, self._tag(source))
+        info = yield self.spawner.inspect_image(reference)
+        labels = ((info or {}).get('Config') or {}).get('Labels') or {}
+        if (info is None or labels.get(dockworker.WARM_SOURCE_LABEL) != source['id'] or
+                labels.get(dockworker.WARM_SCRIPT_LABEL) != self.script_hash or
+                labels.get(dockworker.BAKE_LABEL)):
+            raise gen.Return(None)
+        raise gen.Return({'id': info['Id'], 'reference': reference, 'source': source['id']})
+
+    @gen.coroutine
+    def _bake(self, source_id, tag):
+        loop = ioloop.IOLoop.current()
+        started = loop.time()
+        user = new_user(8)
+        path = '/user/{}/'.format(user)
+        name = 'bake.{}.{}'.format(self.labels[dockworker.BAKE_LABEL], user)
+        self.baking = {'source': source_id, 'tag': tag, 'status': 'booting'}
+        app_log.info("Baking warm image [%s:%s] from [%s].", self.repository, tag, source_id)
+
+        container_id = None
+        try:
+            container_id, ip, port, token = yield self.spawner.create_notebook_server(
+                base_path=path, container_name=name,
+                container_config=self.container_config._replace(image=source_id),
+                labels=self.labels)
+            yield self.probe.wait(ip, port, path, image=source_id, token=token)
+
+            self.baking['status'] = 'warming'
+            code, output = yield gen.with_timeout(
+                timedelta(seconds=self.timeout),
+                self.spawner.exec_in_container(container_id, ['sh', '-c', self.script],
+                                               user=self.container_config.container_user))
+            if code != 0:
+                raise Exception("The warmup script exited with status {}:\n{}".format(
+                    code, output[-4000:]))
+            app_log.debug("Warmup script output:\n%s", output)
+
+            self.baking['status'] = 'cleaning'
+            code, output = yield self.spawner.exec_in_container(
+                container_id, ['sh', '-c', CLEAR_RUNTIME],
+                user=self.container_config.container_user)
+            if code != 0:
+                raise Exception("Unable to clear the server's runtime files ({}):\n{}".format(
+                    code, output[-4000:]))
+
+            self.baking['status'] = 'committing'
+            image_id = yield self.spawner.commit_container(
+                container_id, self.repository, tag,
+                labels={dockworker.BAKE_LABEL: '',
+                        dockworker.WARM_SOURCE_LABEL: source_id,
+                        dockworker.WARM_SCRIPT_LABEL: self.script_hash},
+                comment="Warmed up by tmpnb")
+        finally:
+            self.baking = None
+            if container_id is not None:
+                yield self._discard(container_id)
+
+        app_log.info("Baked warm image [%s:%s] in %.1fs.", self.repository, tag,
+                     loop.time() - started)
+        raise gen.Return(image_id)
+
+    @gen.coroutine
+    def _discard(self, container_id):
+        try:
+            yield self.spawner.destroy_notebook_server(container_id)
+        except Exception as e:
+            app_log.error("Unable to remove template container [%s]: %s", container_id, e)
+
+    def _promote(self, image):
+        '''Switch to `image`, returning whether that changed the image containers are built
+        from.'''
+
+        old_pinned = self.pinned
+        old, self.current = self.current, image
+        if self.pinned == old_pinned:
+            return False
+        app_log.info("Building containers from [%s] (was [%s]).", self.pinned, old_pinned)
+        for callback in self._listeners:
+            callback(old, image)
+        return True
+
+    def stats(self):
+        stats = self.source.stats()
+        stats.update({
+            'warm': self.current,
+            'baking': self.baking,
+        })
+        return stats
+
+
 class SpawnPool():
     '''Manage a pool of precreated Docker containers.'''
 
@@ -63,6 +996,23 @@ class SpawnPool():
                  max_age,
                  pool_name,
                  user_length,
+                 low_water=None,
+                 high_water=None,
+                 max_capacity=None,
+                 created_capacity=0,
+                 pause_pooled=False,
+                 thaw_timeout=2,
+                 pooled_mem_limit=None,
+                 launcher=None,
+                 reaper=None,
+                 networks=None,
+                 images=None,
+                 upgrade_surge=1,
+                 probe=None,
+                 quarantine_size=10,
+                 failure_threshold=5,
+                 failure_pause=60,
+                 store=None,
                  static_files=None,
                  static_dump_path=os.path.join(os.path.dirname(__file__),
                                                "static")):
@@ -70,93 +1020,379 @@ class SpawnPool():
 
         self.spawner = spawner
         self.container_config = container_config
+        self.launcher = launcher or LaunchScheduler()
+        self.reaper = reaper if reaper is not None else Reaper()
+        self.reaper.bind(self._destroy, self._abandon)
+        self.probe = probe if probe is not None else ReadinessProbe()
+        # Failed launches, by stage, and the most recent failed containers with their logs.
+        self.failures = dict((stage, 0) for stage in LAUNCH_STAGES)
+        self.quarantine = deque(maxlen=quarantine_size)
+        # After `failure_threshold` containers of one image fail to boot in a row, refills are
+        # paused for `failure_pause` seconds.
+        self.failure_threshold = failure_threshold
+        self.failure_pause = failure_pause
+        self._boot_failures = {}
+        self._paused_until = 0
+        # Optional NetworkPool giving each container an isolated network.
+        self.networks = networks
+        # Optional ImageManager pinning the image containers are created from.
+        self.images = images
+        # Number of containers a rolling upgrade may launch beyond the capacity at once.
+        self.upgrade_surge = max(1, upgrade_surge)
+        # Progress of the current or last rolling upgrade.
+        self.rollout = None
+        # capacity is the number of containers the pool is normally kept at, while max_capacity
+        # is a ceiling that launches made for waiting requests may burst up to. Burst containers
+        # are not replaced when they are culled, so the pool shrinks back on its own.
         self.capacity = capacity
+        self.max_capacity = max(capacity, max_capacity or capacity)
+        # Number of containers to keep created, but not started, behind the running pool.
+        self.created_capacity = created_capacity
+        # Pooled containers may be paused while they wait, and unpaused when acquired.
+        self.pause_pooled = pause_pooled
+        self.thaw_timeout = thaw_timeout
+        # Containers made for the pool are created with this smaller memory limit, which is
+        # raised to the configured one when they are acquired.
+        self.pooled_mem_limit = pooled_mem_limit or container_config.mem_limit
         self.max_idle = max_idle
         self.max_age = max_age
 
         self.pool_name = pool_name
         self.container_name_pattern = re.compile('tmp\.([^.]+)\.(.+)\Z')
+        # Labels shared by every container in this pool.
+        self.labels = {dockworker.POOL_LABEL: pool_name}
 
         self.proxy_endpoint = proxy_endpoint
         self.proxy_token = proxy_token
 
         self.user_length = user_length
 
-        self.available = deque()
-        self.started = {}
+        # Refill watermarks for the available pool. Refills begin once fewer than low_water
+        # containers are available (or on their way), and stop once high_water is reached.
+        if high_water is None:
+            high_water = capacity
+        if low_water is None:
+            low_water = high_water
+        self.high_water = min(high_water, capacity)
+        self.low_water = min(low_water, self.high_water)
+
+        self.registry = ContainerRegistry(store)
+
+        # Futures of callers waiting for a container, served first come, first served.
+        self._waiters = deque()
+        self.jobs = OrderedDict()
 
         self.static_files = static_files
         self.static_dump_path = static_dump_path
 
         self._heart_beating = False
+        self._launching = 0
+        self._preparing = False
+        self._preparing_names = set()
+        self._surge = 0
+
+        self.phase = STARTING
+        # Set once leftovers from the previous run have been adopted or removed.
+        self.started = Event()
+        # Set once the pool has a container to serve.
+        self.serving = Event()
+
+    @gen.coroutine
+    def start(self, cleanout_concurrency=16):
+        '''Take over from the previous run and begin filling the pool.
+
+        Returns once leftover containers have been adopted or removed, without waiting for the
+        pool to fill: containers are served as they come up, and `phase` moves on to READY once
+        the pool first reaches its high watermark.'''
+
+        if self.images is not None:
+            yield self.images.start()
+        yield self.adopt()
+        yield self.cleanout(cleanout_concurrency)
+        self.started.set()
+        self.phase = WARMING
+        app_log.info("Pool is warming up from [%i] containers.", len(self.available))
+        self._check_warm()
+        ioloop.IOLoop.current().spawn_callback(self.heartbeat)
+
+    def _check_warm(self):
+        available = self.registry.count(POOLED)
+        if available:
+            self.serving.set()
+        if self.phase == WARMING and available >= self.high_water:
+            app_log.info("Pool is warm, with [%i] containers available.", available)
+            self.phase = READY
+
+    @property
+    def image(self):
+        '''The image new containers are created from, pinned by the image manager if there is
+        one.'''
+
+        if self.images is not None:
+            return self.images.pinned
+        return self.container_config.image
+
+    @property
+    def available(self):
+        '''Containers ready to be handed out, oldest first.'''
+
+        return self.registry.in_state(POOLED)
 
     def acquire(self):
         '''Acquire a preallocated container and returns its user path.
 
         An EmptyPoolError is raised if no containers are ready.'''
 
-        if not self.available:
+        container = self.registry.newest(POOLED)
+        if container is None:
             raise EmptyPoolError()
 
-        container = self.available.pop()
-        # signal start on acquisition
-        self.started[container.id] = datetime.utcnow()
+        self._assign(container)
+        self._maybe_refill()
         return container
 
+    def _assign(self, container):
+        # signal start on acquisition
+        self.registry.transition(container, ASSIGNED)
+        container.acquired = container.updated
+        self.registry.save(container)
+
     @gen.coroutine
-    def adhoc(self, user):
+    def acquire_wait(self, timeout=None, cancelled=None):
+        '''Acquire a preallocated container, waiting up to `timeout` seconds for one to finish
+        launching if none are ready.
+
+        Waiters are handed containers in the order they arrived. An EmptyPoolError is raised if the
+        deadline passes first, or immediately if no timeout is given. Pooled containers are made
+        ready for their user (unpaused, given their full memory limit) before being returned; any
+        that cannot be are discarded for the next.
+
+        The request is withdrawn once the `cancelled` Future resolves, for instance when the
+        client has gone away: an EmptyPoolError is raised, and a container it was handed in the
+        meantime is released rather than left assigned to nobody.'''
+
+        loop = ioloop.IOLoop.current()
+        deadline = loop.time() + (timeout or 0)
+        while True:
+            container = yield self._acquire_or_wait(max(0, deadline - loop.time()), cancelled)
+            activated = yield self._activate(container)
+            if cancelled is not None and cancelled.done():
+                app_log.info("Releasing container [%s], whose request was withdrawn.", container)
+                loop.spawn_callback(self.release, container)
+                raise EmptyPoolError()
+            if activated:
+                raise gen.Return(container)
+            app_log.warning("Discarding container [%s], which could not be activated.", container)
+            loop.spawn_callback(self.release, container, False)
+
+    @gen.coroutine
+    def _activate(self, container):
+        '''Undo the economies applied to a container while it sat in the pool. Returns whether it
+        is ready for use.'''
+
+        if container.paused:
+            thawed = yield self._thaw(container)
+            if not thawed:
+                raise gen.Return(False)
+        if container.mem_limit != self.container_config.mem_limit:
+            try:
+                yield self.spawner.resize_notebook_server(container.id,
+                                                          self.container_config.mem_limit)
+            except Exception as e:
+                app_log.error("Unable to raise the memory limit of container [%s]: %s",
+                              container, e)
+                raise gen.Return(False)
+            container.mem_limit = self.container_config.mem_limit
+            self.registry.save(container)
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def _acquire_or_wait(self, timeout, cancelled=None):
+        if self.registry.count(POOLED) or not timeout:
+            raise gen.Return(self.acquire())
+
+        waiter = Future()
+        self._waiters.append(waiter)
+        if cancelled is not None:
+            def withdraw(future):
+                # Only a waiter still in line has yet to be handed a container.
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    waiter.set_exception(EmptyPoolError())
+            cancelled.add_done_callback(withdraw)
+        app_log.debug("Pool is empty; queueing request behind [%i] others.", len(self._waiters) - 1)
+        # Whichever launch finishes first goes to the oldest waiter, so a queued background
+        # refill can be moved ahead just as well as a new launch.
+        self.launcher.promote(1)
+        self._maybe_refill()
+        try:
+            container = yield gen.with_timeout(timedelta(seconds=timeout), waiter)
+        except gen.TimeoutError:
+            # Still unresolved, since only pending waiters are ever handed a container.
+            self._waiters.remove(waiter)
+            raise EmptyPoolError()
+        raise gen.Return(container)
+
+    def submit_job(self, timeout):
+        '''Queue an acquisition in the background and return a SpawnJob that can be looked up
+        by id in `self.jobs` until it has been collected or has expired.'''
+
+        job = SpawnJob(new_user(self.user_length), self.acquire_wait(timeout))
+        self.jobs[job.id] = job
+
+        def expire(future):
+            # Mark any exception as observed, then forget the job if nobody collects it.
+            future.exception()
+            ioloop.IOLoop.current().call_later(timeout, forget)
+
+        def forget():
+            if self.jobs.pop(job.id, None) is None or job.status != 'ready':
+                return
+            # Nobody came for the container, which would otherwise hold its place until culled.
+            app_log.info("Releasing container [%s] of expired spawn job [%s].", job.container,
+                         job.id)
+            ioloop.IOLoop.current().spawn_callback(self.release, job.container)
+        job.future.add_done_callback(expire)
+        return job
+
+    @gen.coroutine
+    def adhoc(self, user, timeout=None):
         '''Launch a container with a fixed path by taking the place of an existing container from
         the pool.'''
 
-        to_release = self.acquire()
+        to_release = yield self.acquire_wait(timeout)
         app_log.debug("Discarding container [%s] to create an ad-hoc replacement.", to_release)
         yield self.release(to_release, False)
 
-        launched = yield self._launch_container(user=user, enpool=False)
-        self.started[launched.id] = datetime.utcnow()
+        launched = yield self._launch_container(user=user, enpool=False,
+                                                priority=LaunchScheduler.URGENT)
+        self._assign(launched)
         raise gen.Return(launched)
 
     @gen.coroutine
     def release(self, container, replace_if_room=True):
         '''Shut down a container and delete its proxy entry.
 
-        Destroy the container in an orderly fashion. If requested and capacity is remaining, create
-        a new one to take its place.'''
+        The container is unrouted and handed to the reaper, which removes it from Docker in the
+        background. If requested and capacity is remaining, create a new one to take its place.'''
 
-        try:
-            app_log.info("Releasing container [%s].", container)
-            self.started.pop(container.id, None)
-            yield [
-                self.spawner.shutdown_notebook_server(container.id),
-                self._proxy_remove(container.path)
-            ]
-            app_log.debug("Container [%s] has been released.", container)
-        except Exception as e:
-            app_log.error("Unable to release container [%s]: %s", container, e)
+        if container.state == RELEASING:
+            # Already on its way out.
             return
-
-        if replace_if_room:
-            running = yield self.spawner.list_notebook_servers(self.container_name_pattern, all=False)
-            if len(running) + 1 <= self.capacity:
+        app_log.info("Releasing container [%s].", container)
+        routed = container.state != CREATED
+        # The container stops counting against the capacity here; Docker catches up later.
+        self._reap(container)
+        if routed:
+            yield self._proxy_remove(container.path)
+
+        if not replace_if_room:
+            self._maybe_refill()
+        else:
+            running = self._running_estimate()
+            if running < self.capacity:
                 app_log.debug("Launching a replacement container.")
-                yield self._launch_container()
+                yield self._try_launch_container()
             else:
                 app_log.info("Declining to launch a new container because [%i] containers are" +
                              " already running, and the capacity is [%i].",
-                             len(running), self.capacity)
+                             running, self.capacity)
 
     @gen.coroutine
-    def cleanout(self):
-        '''Completely cleanout containers that are part of this pool.'''
+    def cleanout(self, concurrency=16):
+        '''Completely cleanout containers that are part of this pool, except those it has
+        adopted. Up to `concurrency` containers are removed at once.'''
         app_log.info("Performing initial pool cleanup")
 
-        containers = yield self.spawner.list_notebook_servers(self.container_name_pattern, all=True)
-        for container in containers:
-            try:
-                app_log.debug("Clearing old container [%s] from pool", container['Id'])
-                yield self.spawner.shutdown_notebook_server(container['Id'])
-            except Exception as e:
-                app_log.warn(e)
+        containers = yield self.spawner.list_notebook_servers(self.labels, all=True)
+        slots = Semaphore(concurrency)
+
+        @gen.coroutine
+        def clear(id):
+            with (yield slots.acquire()):
+                try:
+                    app_log.debug("Clearing old container [%s] from pool", id)
+                    yield self.spawner.destroy_notebook_server(id)
+                except Exception as e:
+                    app_log.warn(e)
+
+        yield [clear(container['Id']) for container in containers
+               if self.registry.get(container['Id']) is None]
+
+        if self.networks is not None:
+            yield self.networks.adopt(set(container.network for container in self.registry
+                                          if container.network is not None))
+
+    @gen.coroutine
+    def adopt(self):
+        '''Take back the containers a previous run left behind, as recorded in the registry's
+        store. Run before the cleanout, which removes everything that isn't adopted.
+
+        Pooled, assigned and created containers are adopted if Docker still has them in the
+        same condition and, for running ones, their servers still answer. Routes missing from
+        the proxy are restored. Returns the number of containers adopted.'''
+
+        store = self.registry.store
+        if store is None:
+            raise gen.Return(0)
+        records = store.load()
+        if not records:
+            raise gen.Return(0)
+
+        containers = yield self.spawner.list_notebook_servers(self.labels, all=True)
+        docker = dict((info['Id'], info) for info in containers)
+        routes = yield proxy_routes(self.proxy_endpoint, self.proxy_token)
+        results = yield [self._adopt(record, docker.get(record['id']), routes.get(record['path']))
+                         for record in records]
+        # Only forget the others once adoption is over, so that a run that fails part way
+        # through leaves the records for the next one.
+        store.forget([record['id'] for record, result in zip(records, results) if not result])
+        adopted = sum(1 for result in results if result)
+        app_log.info("Adopted [%i] of [%i] containers left by the previous run.",
+                     adopted, len(records))
+        raise gen.Return(adopted)
+
+    @gen.coroutine
+    def _adopt(self, record, info, route):
+        if info is None or record['state'] not in (POOLED, ASSIGNED, CREATED):
+            raise gen.Return(False)
+        status = info.get('Status') or ''
+        running = status.startswith('Up')
+        if running != (record['state'] != CREATED):
+            raise gen.Return(False)
+
+        container = PooledContainer(id=record['id'], path=record['path'], token=record['token'],
+                                    name=record['name'], state=record['state'],
+                                    labels=record['labels'])
+        for field in ('container_port', 'host_ip', 'host_port', 'mem_limit', 'network'):
+            setattr(container, field, record[field])
+        container.created = record['created'] or container.created
+        container.acquired = record['acquired']
+        container.paused = '(Paused)' in status
+
+        try:
+            if running and not container.paused:
+                healthy = yield self.probe.check(container.host_ip, container.host_port,
+                                                 container.path, container.token)
+                if not healthy:
+                    raise Exception("its server does not answer")
+            # Containers started straight away by an older run have no container port on
+            # record; they listen on their host port wherever the port is fixed.
+            if container.container_port is not None:
+                port = container.container_port
+            else:
+                port = container.host_port
+            yield self.spawner.adopt_notebook_server(container.id, port,
+                                                     self._launch_config(container))
+            if running and (route or {}).get('container_id') != container.id:
+                app_log.info("Restoring the route to container [%s].", container)
+                yield self._proxy_add(container)
+        except Exception as e:
+            app_log.warning("Not adopting container [%s]: %s", container, e)
+            raise gen.Return(False)
+
+        self.registry.add(container)
+        raise gen.Return(True)
 
     @gen.coroutine
     def drain(self):
@@ -176,8 +1412,110 @@ class SpawnPool():
             except EmptyPoolError:
                 # No more free containers left to acquire
                 break
+        drained = len(tasks)
+
+        # Created containers would come up with the old image too.
+        for created in self.registry.in_state(CREATED):
+            tasks.append(self.release(created, replace_if_room=False))
         yield tasks
-        raise gen.Return(len(tasks))
+        self._maybe_prepare()
+        raise gen.Return(drained)
+
+    @property
+    def upgrading(self):
+        return self.rollout is not None and self.rollout['state'] in ('pulling', 'rolling')
+
+    def upgrade(self, surge=None):
+        '''Start replacing the pool's containers with ones from the current image, in the
+        background. Returns False if an upgrade is already underway.
+
+        Progress is kept in `self.rollout`.'''
+
+        if self.upgrading:
+            return False
+        self.rollout = {
+            'state': 'pulling',
+            'image': self.image,
+            'surge': max(1, surge or self.upgrade_surge),
+            'total': 0,
+            'replaced': 0,
+            'remaining': 0,
+            'started': datetime.utcnow().strftime(_date_fmt),
+            'finished': None,
+            'error': None,
+        }
+        ioloop.IOLoop.current().spawn_callback(self._roll)
+        return True
+
+    def _stale(self):
+        '''Containers waiting in the pool or created tier from an image other than the current
+        one.'''
+
+        return [container for container in self.registry.in_state(POOLED, CREATED)
+                if container.labels.get(dockworker.IMAGE_LABEL) != self.image]
+
+    @gen.coroutine
+    def _roll(self):
+        '''Pull the newest image, then replace stale pooled containers one at a time, retiring
+        each only once a new container is ready to take its place.
+
+        Up to `surge` replacements are launched at once beyond the capacity, so the pool never
+        shrinks while it is being replaced.'''
+
+        rollout = self.rollout
+        try:
+            # Adoption and the cleanout decide which containers there are to replace.
+            yield self.started.wait()
+            if self.images is not None:
+                yield self.images.update()
+            rollout['image'] = self.image
+            rollout['state'] = 'rolling'
+            rollout['total'] = len(self._stale())
+            app_log.info("Rolling [%i] containers over to image [%s], [%i] at a time.",
+                         rollout['total'], self.image, rollout['surge'])
+            self._surge = rollout['surge']
+
+            while True:
+                stale = self._stale()
+                rollout['remaining'] = len(stale)
+                # The created tier serves nobody yet, so it can simply be replaced.
+                created = [container for container in stale if container.state == CREATED]
+                for container in created:
+                    yield self.release(container, replace_if_room=False)
+                pooled = [container for container in stale if container.state == POOLED]
+                if not pooled:
+                    break
+
+                launched = yield [self._try_launch_container()
+                                  for i in range(min(rollout['surge'], len(pooled)))]
+                ready = [container for container in launched if container is not None]
+                if not ready:
+                    raise Exception("Unable to launch replacement containers.")
+                for container in ready:
+                    # Retire whichever stale container is still pooled; others may have been
+                    # acquired in the meantime.
+                    stale = [old for old in self._stale() if old.state == POOLED]
+                    if not stale:
+                        break
+                    retired = stale[0]
+                    self._assign(retired)
+                    app_log.info("Retiring container [%s] in favor of [%s].", retired, container)
+                    yield self.release(retired, replace_if_room=False)
+                    rollout['replaced'] += 1
+
+            rollout['remaining'] = 0
+            rollout['state'] = 'done'
+            app_log.info("Rolling upgrade to image [%s] complete: [%i] containers replaced.",
+                         self.image, rollout['replaced'])
+        except Exception as e:
+            app_log.error("Rolling upgrade to image [%s] failed: %s", self.image, e)
+            rollout['state'] = 'failed'
+            rollout['error'] = str(e)
+        finally:
+            self._surge = 0
+            rollout['finished'] = datetime.utcnow().strftime(_date_fmt)
+            # Refill the created tier with the new image, as drain does.
+            self._maybe_prepare()
 
     @gen.coroutine
     def heartbeat(self):
@@ -196,41 +1534,45 @@ class SpawnPool():
 
             diagnosis = Diagnosis(self.max_idle,
                                   self.max_age,
-                                  self.spawner,
-                                  self.container_name_pattern,
+                                  self.registry,
                                   self.proxy_endpoint,
                                   self.proxy_token,
-                                  self.started,
                                   )
             yield diagnosis.observe()
 
             tasks = []
 
             for id in diagnosis.stopped_container_ids:
-                app_log.debug("Removing stopped container [%s].", id)
-                tasks.append(self.spawner.shutdown_notebook_server(id, alive=False))
+                container = self.registry.get(id)
+                if container is not None and container.state == DEAD:
+                    app_log.debug("Removing stopped container [%s].", id)
+                    tasks.append(self._remove_dead(container))
 
             for path, id in diagnosis.zombie_routes:
                 app_log.debug("Removing zombie route [%s].", path)
                 tasks.append(self._proxy_remove(path))
 
             unpooled_stale_routes = [(path, id) for path, id in diagnosis.stale_routes
-                                        if id not in self._pooled_ids()]
+                                        if getattr(self.registry.get(id), 'state', None) == ASSIGNED]
             for path, id in unpooled_stale_routes:
                 app_log.debug("Replacing stale route [%s] and container [%s].", path, id)
-                container = PooledContainer(path=path, id=id, token='')
-                tasks.append(self.release(container, replace_if_room=True))
+                tasks.append(self.release(self.registry.get(id), replace_if_room=True))
 
             # Normalize the container count to its initial capacity by scheduling deletions if we're
-            # over or scheduling launches if we're under.
-            current = len(diagnosis.living_container_ids)
+            # over or scheduling launches if we're under. A rolling upgrade may run over by its
+            # surge; it retires the old containers itself.
+            current = self._running_estimate()
             under = range(current, self.capacity)
-            over = range(self.capacity, current)
+            over = range(self.capacity + self._surge, current)
+
+            if under and self.refills_paused:
+                app_log.warning("Refills are paused; holding off on [%i] launches.", len(under))
+                under = range(0)
 
             if under:
                 app_log.info("Launching [%i] new containers to populate the pool.", len(under))
             for i in under:
-                tasks.append(self._launch_container())
+                tasks.append(self._try_launch_container())
 
             if over:
                 app_log.info("Removing [%i] containers to diminish the pool.", len(over))
@@ -257,16 +1599,186 @@ class SpawnPool():
             summarize("Launched [%i] new containers.", under)
             summarize("Removed [%i] excess containers from the pool.", over)
 
+            self._maybe_prepare()
+
             app_log.debug("Heartbeat complete. The pool now includes [%i] containers.",
                           len(self.available))
         finally:
             self._heart_beating = False
 
+    def _running_estimate(self):
+        '''Count the containers this pool is responsible for without asking Docker: pooled,
+        assigned, and in-flight launches.'''
+
+        return self.registry.count(*LIVE_STATES)
+
+    def _refill_deficit(self):
+        '''Number of launches needed to serve every waiter and bring the pool back up to its high
+        watermark. Refills are bounded by the capacity, but launches for waiting requests may
+        burst up to max_capacity.'''
+
+        supply = self.registry.count(POOLED) + self._launching
+        # While refills are paused, only launch for requests that are waiting.
+        high_water = 0 if self.refills_paused else self.high_water
+        wanted = high_water + len(self._waiters) - supply
+        burst = len(self._waiters) - supply
+
+        running = self._running_estimate()
+        room = max(self.capacity - running, min(burst, self.max_capacity - running))
+        return max(0, min(wanted, room))
+
+    def _maybe_refill(self):
+        '''Launch containers in the background if the pool has dropped below its low watermark,
+        enough to bring it back up to the high watermark or the capacity.
+
+        Containers already launching count towards the pool, so each call only launches what is
+        still missing, and concurrent acquisitions never over-launch. A failed launch is left to
+        the next acquisition or heartbeat to repair, rather than spinning on it.'''
+
+        if self.phase == STARTING:
+            return
+        if self.registry.count(POOLED) + self._launching - len(self._waiters) >= self.low_water:
+            return
+        deficit = self._refill_deficit()
+        if not deficit:
+            return
+        app_log.info("Refilling the pool with [%i] containers (%i available).",
+                     deficit, len(self.available))
+        supply = self.registry.count(POOLED) + self._launching
+        urgent = max(0, min(deficit, len(self._waiters) - supply))
+        for i in range(deficit):
+            # Started here rather than spawned, so that each launch counts towards the pool
+            # before this returns. They log their own failures.
+            self._try_launch_container(LaunchScheduler.URGENT if i < urgent
+                                       else LaunchScheduler.BACKGROUND)
+
+    @gen.coroutine
+    def _try_launch_container(self, priority=LaunchScheduler.BACKGROUND):
+        '''Launch a pooled container, logging rather than propagating any failure.'''
+
+        try:
+            container = yield self._launch_container(priority=priority)
+        except Exception as e:
+            app_log.error("Unable to launch a container to refill the pool: %s", e)
+            raise gen.Return(None)
+        raise gen.Return(container)
+
     @gen.coroutine
-    def _launch_container(self, user=None, enpool=True):
+    def _launch_container(self, user=None, enpool=True, priority=LaunchScheduler.BACKGROUND):
         '''Launch a new notebook server in a fresh container, register it with the proxy, and
-        add it to the pool.'''
+        add it to the pool.
+
+        Containers from the created tier are used first, when there are any, so only a start is
+        needed. Docker calls are queued on the launch scheduler with the given priority.'''
+
+        container = None
+        if user is None:
+            container = self._take_created()
+        if container is None:
+            container = self._new_container(user)
+            self.registry.add(container)
+
+        if enpool:
+            self._launching += 1
+        try:
+            yield self._create_and_route(container, priority)
+            if container.state != BOOTING:
+                raise LaunchError('boot', "Container [{}] died while booting.".format(
+                    container.id))
+        except LaunchError as e:
+            self._roll_back(container, e)
+            raise
+        finally:
+            if enpool:
+                self._launching -= 1
+
+        self._boot_failures.pop(self._image_of(container), None)
+
+        if enpool:
+            self._enpool(container)
+
+        raise gen.Return(container)
+
+    def _roll_back(self, container, error):
+        '''Undo a failed launch: unroute the container and quarantine it for removal.'''
+
+        self.failures[error.stage] += 1
+        app_log.error("Launch of container [%s] failed: %s", container, error)
+        if error.stage == 'boot':
+            self._boot_failed(self._image_of(container))
+
+        if container.id is None:
+            self.registry.remove(container)
+            self._recycle_network(container)
+            return
+        if container.state == RELEASING:
+            # It died, and is already on its way out.
+            return
+        loop = ioloop.IOLoop.current()
+        if error.stage == 'route':
+            # The route may have been added even though the proxy didn't answer.
+            loop.spawn_callback(self._proxy_remove, container.path)
+        self.registry.transition(container, RELEASING)
+        loop.spawn_callback(self._quarantine, container, error)
+
+    @gen.coroutine
+    def _quarantine(self, container, error):
+        '''Capture the logs of a container that failed to launch, then have it removed.'''
 
+        try:
+            logs = yield self.spawner.container_logs(container.id)
+        except Exception as e:
+            app_log.warning("Unable to capture the logs of container [%s]: %s", container, e)
+            logs = None
+        self.quarantine.append({
+            'id': container.id,
+            'name': container.name,
+            'image': self._image_of(container),
+            'stage': error.stage,
+            'error': str(error.error),
+            'logs': logs,
+            'time': datetime.utcnow().strftime(_date_fmt),
+        })
+        app_log.warning("Quarantined container [%s] after it failed to %s. Its logs:\n%s",
+                        container, error.stage, logs)
+        self.reaper.enqueue(container)
+
+    def _image_of(self, container):
+        return container.labels.get(dockworker.IMAGE_LABEL, self.image)
+
+    def _boot_failed(self, image):
+        failures = self._boot_failures.get(image, 0) + 1
+        self._boot_failures[image] = failures
+        if failures >= self.failure_threshold and image == self.image:
+            app_log.error("[%i] containers of image [%s] failed to boot in a row; pausing "
+                          "refills for [%i] seconds.", failures, image, self.failure_pause)
+            self._paused_until = ioloop.IOLoop.current().time() + self.failure_pause
+            # Start over, so that the next round of failures is needed to pause again.
+            self._boot_failures[image] = 0
+
+    @property
+    def refills_paused(self):
+        '''Whether refills are held back, because Docker is overloaded or the image keeps
+        failing. Only launches for waiting requests go ahead meanwhile.'''
+
+        if self.spawner.overloaded:
+            return True
+        return ioloop.IOLoop.current().time() < self._paused_until
+
+    def admission_stats(self):
+        loop = ioloop.IOLoop.current()
+        return {
+            'failures': dict(self.failures),
+            'consecutive_boot_failures': dict(self._boot_failures),
+            'paused_for': max(0, self._paused_until - loop.time()),
+            'quarantined': len(self.quarantine),
+        }
+
+    def _new_container(self, user=None):
+        '''Build the record for a brand new container, with a fresh user path unless one is
+        given.'''
+
+        fixed = user is not None
         if user is None:
             user = new_user(self.user_length)
 
@@ -278,97 +1790,376 @@ class SpawnPool():
         if not self.container_name_pattern.match(container_name):
             raise Exception("[{}] does not match [{}]!".format(container_name,
                 self.container_name_pattern.pattern))
+        labels = dict(self.labels)
+        labels.update({
+            dockworker.PATH_LABEL: path,
+            dockworker.USER_LABEL: user,
+            dockworker.CREATED_LABEL: datetime.utcnow().strftime(_date_fmt),
+            dockworker.IMAGE_LABEL: self.image,
+        })
 
         app_log.debug("Launching new notebook server [%s] at path [%s].",
                 container_name, path)
-        create_result = yield self.spawner.create_notebook_server(base_path=path,
-                                                                  container_name=container_name,
-                                                                  container_config=self.container_config)
-        print('create_result', create_result)
+        container = PooledContainer(id=None, path=path, name=container_name, labels=labels)
+        # Ad-hoc containers go straight to their user, so only pooled ones start out small.
+        if fixed:
+            container.mem_limit = self.container_config.mem_limit
+        else:
+            container.mem_limit = self.pooled_mem_limit
+        return container
+
+    def _launch_config(self, container):
+        '''The ContainerConfig to create `container` with.'''
+
+        changes = {'image': container.labels.get(dockworker.IMAGE_LABEL, self.image),
+                   'mem_limit': container.mem_limit}
+        if container.network is not None:
+            changes['docker_network'] = container.network
+        return self.container_config._replace(**changes)
+
+    @gen.coroutine
+    def _assign_network(self, container):
+        '''Give a container about to be created an isolated network, if they are in use.'''
+
+        if self.networks is not None and container.network is None:
+            container.network = yield self.networks.take()
+
+    def _recycle_network(self, container):
+        if self.networks is not None:
+            self.networks.recycle(container.network)
+            container.network = None
+
+    def _take_created(self):
+        '''Claim the oldest container from the created tier, if any, and top the tier back up.'''
+
+        created = self.registry.in_state(CREATED)
+        if not created:
+            return None
+        container = created[0]
+        self.registry.transition(container, CREATING)
+        self._maybe_prepare()
+        return container
+
+    def _maybe_prepare(self):
+        '''Schedule the created tier to be topped up if it is below its target size.'''
+
+        if self._preparing or self.registry.count(CREATED) >= self.created_capacity:
+            return
+        if self.refills_paused:
+            return
+        self._preparing = True
+        ioloop.IOLoop.current().spawn_callback(self._prepare)
+
+    @gen.coroutine
+    def _prepare(self):
+        '''Create containers, without starting them, until the created tier is full.'''
+
+        try:
+            while True:
+                deficit = (self.created_capacity - self.registry.count(CREATED) -
+                           len(self._preparing_names))
+                if deficit <= 0:
+                    break
+                app_log.debug("Creating [%i] containers for the created tier.", deficit)
+                results = yield [self._prepare_container() for i in range(deficit)]
+                if not all(results):
+                    break
+        finally:
+            self._preparing = False
+
+    @gen.coroutine
+    def _prepare_container(self):
+        '''Create a container for the created tier at low priority. Returns it, or None if the
+        creation failed.'''
+
+        container = self._new_container()
+        self._preparing_names.add(container.name)
+        try:
+            yield self._assign_network(container)
+            result = yield self.launcher.submit(
+                lambda: self.spawner.create_notebook_container(
+                    base_path=container.path,
+                    container_name=container.name,
+                    container_config=self._launch_config(container),
+                    labels=container.labels),
+                LaunchScheduler.LOW)
+        except Exception as e:
+            app_log.error("Unable to create a container for the created tier: %s", e)
+            self.failures['create'] += 1
+            self._recycle_network(container)
+            raise gen.Return(None)
+        finally:
+            self._preparing_names.discard(container.name)
+
+        container.id, container.container_port, container.token = result
+        container.state = CREATED
+        self.registry.add(container)
+        raise gen.Return(container)
+
+    def _enpool(self, container):
+        '''Hand a freshly launched container to the oldest waiter, or add it to the pool.'''
+
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            app_log.info("Handing container [%s] to a waiting request.", container)
+            self._assign(container)
+            waiter.set_result(container)
+            return
+
+        app_log.info("Adding container [%s] to the pool.", container)
+        self.registry.transition(container, POOLED)
+        if self.pause_pooled:
+            self._freeze(container)
+        self._check_warm()
+
+    def _freeze(self, container):
+        '''Pause a pooled container so it uses no CPU until it is acquired.'''
+
+        container.paused = True
+        container.freezing = self.spawner.pause_notebook_server(container.id)
+
+        def frozen(future):
+            if future.exception() is not None:
+                app_log.warning("Unable to pause container [%s]: %s", container, future.exception())
+        container.freezing.add_done_callback(frozen)
+
+    @gen.coroutine
+    def _unfreeze(self, container):
+        '''Unpause a container, once any pause still in flight has finished.'''
+
+        # Adopted containers were paused by a previous run, with no pause in flight.
+        if container.freezing is not None:
+            try:
+                yield container.freezing
+            except Exception:
+                # The pause never took effect.
+                container.paused = False
+                return
+        yield self.spawner.unpause_notebook_server(container.id)
+        container.paused = False
+
+    @gen.coroutine
+    def _thaw(self, container):
+        '''Unpause an acquired container and check that its server answers again. Returns whether
+        it is ready for use.'''
+
+        try:
+            yield self._unfreeze(container)
+            stream = yield gen.with_timeout(
+                timedelta(seconds=self.thaw_timeout),
+                TCPClient().connect(container.host_ip, container.host_port))
+            stream.close()
+        except Exception as e:
+            app_log.error("Container [%s] failed its check after unpausing: %s", container, e)
+            raise gen.Return(False)
+        raise gen.Return(True)
 
-        container_id, host_ip, host_port, token = create_result
+    @gen.coroutine
+    def _create_and_route(self, container, priority):
+        '''Create a notebook server, wait for it to boot, and register it with the proxy.
+
+        A LaunchError naming the stage is raised if any of them fails.'''
+
+        path = container.path
+        container_name = container.name
+
+        # Only the Docker calls hold a launch slot; waiting for the server to boot does not.
+        if container.id is None:
+            try:
+                yield self._assign_network(container)
+                container_config = self._launch_config(container)
+                create_result = yield self.launcher.submit(
+                    lambda: self.spawner.create_notebook_container(
+                        base_path=path,
+                        container_name=container_name,
+                        container_config=container_config,
+                        labels=container.labels),
+                    priority)
+            except Exception as e:
+                raise LaunchError('create', e)
+            # Identify it before starting, so that a failed start is rolled back by removing
+            # the container, which frees its port, cpuset and network.
+            container_id, container.container_port, container.token = create_result
+            self.registry.identify(container, container_id)
+        else:
+            # Already created; it only needs starting.
+            container_id = container.id
+            container_config = self._launch_config(container)
+        try:
+            host_ip, host_port = yield self.launcher.submit(
+                lambda: self.spawner.start_notebook_container(container_id,
+                                                              container.container_port,
+                                                              container_config),
+                priority)
+        except Exception as e:
+            raise LaunchError('start', e)
+        container.host_ip = host_ip
+        container.host_port = host_port
+        self.registry.transition(container, BOOTING)
         app_log.debug("Created notebook server [%s] for path [%s] at [%s:%s]", container_name, path, 2
             , host_port)
 
         # Wait for the server to launch within the container before adding it to the pool or
         # serving it to a user.
-        yield self._wait_for_server(host_ip, host_port, path)
+        try:
+            yield self._wait_for_server(container)
+        except Exception as e:
+            raise LaunchError('boot', e)
+
+        try:
+            yield self._proxy_add(container)
+        except Exception as e:
+            # Without a route the container is of no use to anyone.
+            raise LaunchError('route', e)
+
+    @gen.coroutine
+    def _proxy_add(self, container):
+        '''Route a container's path to its server in the proxy.'''
 
         http_client = AsyncHTTPClient()
         headers = {"Authorization": "token {}".format(self.proxy_token)}
 
+        path = container.path
         proxy_endpoint = "{}/api/routes{}".format(self.proxy_endpoint, path)
         body = json.dumps({
-            "target": "http://{}:{}".format(host_ip, host_port),
-            "container_id": container_id,
+            "target": "http://{}:{}".format(container.host_ip, container.host_port),
+            "container_id": container.id,
         })
 
-        app_log.debug("Proxying path [%s] to port [%s].", path, host_port)
+        app_log.debug("Proxying path [%s] to port [%s].", path, container.host_port)
         req = HTTPRequest(proxy_endpoint,
                           method="POST",
                           headers=headers,
                           body=body)
-        try:
-            yield http_client.fetch(req)
-            app_log.info("Proxied path [%s] to port [%s].", path, host_port)
-        except HTTPError as e:
-            app_log.error("Failed to create proxy route to [%s]: %s", path, e)
+        yield http_client.fetch(req)
+        app_log.info("Proxied path [%s] to port [%s].", path, container.host_port)
 
-        container = PooledContainer(id=container_id, path=path, token=token)
-        if enpool:
-            app_log.info("Adding container [%s] to the pool.", container)
-            self.available.append(container)
+    @gen.coroutine
+    def _wait_for_server(self, container):
+        '''Wait for the server within a newly launched container to answer.'''
 
-        raise gen.Return(container)
+        app_log.info("Waiting for a container to launch at [%s:%s].",
+                     container.host_ip, container.host_port)
+        yield self.probe.wait(container.host_ip, container.host_port, container.path,
+                              image=container.labels.get(dockworker.IMAGE_LABEL),
+                              token=container.token,
+                              alive=lambda: container.state == BOOTING)
 
     @gen.coroutine
-    def _wait_for_server(self, ip, port, path, timeout=10, wait_time=0.2):
-        '''Wait for a server to show up within a newly launched container.'''
+    def _remove_dead(self, container):
+        '''Remove a container that has stopped or could not be shut down cleanly.'''
 
-        app_log.info("Waiting for a container to launch at [%s:%s].", ip, port)
-        loop = ioloop.IOLoop.current()
-        tic = loop.time()
+        if container.state == DEAD:
+            self._reap(container)
 
-        # Docker starts listening on a socket before the container is fully launched. Wait for that,
-        # first.
-        while loop.time() - tic < timeout:
-            try:
-                socket.create_connection((ip, port))
-            except socket.error as e:
-                app_log.warn("Socket error on boot: %s", e)
-                if e.errno != errno.ECONNREFUSED:
-                    app_log.warn("Error attempting to connect to [%s:%i]: %s",
-                                 ip, port, e)
-                yield gen.Task(loop.add_timeout, loop.time() + wait_time)
-            else:
-                break
+    def _reap(self, container):
+        '''Queue a container to be torn down by the reaper.'''
 
-        # Fudge factor of IPython notebook bootup.
-        # TODO: Implement a webhook in IPython proper to call out when the
-        # notebook server is booted.
-        yield gen.Task(loop.add_timeout, loop.time() + .5)
+        self.registry.transition(container, RELEASING)
+        self.reaper.enqueue(container)
 
-        # Now, make sure that we can reach the Notebook server.
-        http_client = AsyncHTTPClient()
-        req = HTTPRequest("http://{}:{}{}".format(ip, port, path))
+    @gen.coroutine
+    def _destroy(self, container):
+        '''Kill and remove a released container. Called by the reaper.'''
 
-        while loop.time() - tic < timeout:
-            try:
-                yield http_client.fetch(req)
-            except HTTPError as http_error:
-                code = http_error.code
-                app_log.info("Booting server at [%s], getting HTTP status [%s]", path, code)
-                yield gen.Task(loop.add_timeout, loop.time() + wait_time)
-            else:
-                break
+        if container.paused:
+            # The freezer has to let go of a container before it can be killed.
+            yield self._unfreeze(container)
+        yield self.spawner.destroy_notebook_server(container.id)
+        self.registry.remove(container)
+        self._recycle_network(container)
+        app_log.debug("Container [%s] has been removed.", container)
+
+    def _abandon(self, container, error):
+        '''Leave a container the reaper could not remove for the heartbeat to retry.'''
+
+        app_log.error("Unable to remove container [%s]: %s", container, error)
+        if container in self.registry:
+            self.registry.transition(container, DEAD)
+
+    @gen.coroutine
+    def watch(self):
+        '''Follow Docker's event stream and repair the pool as soon as one of its containers dies.
+
+        The periodic reconcile remains as a safety net for anything the stream misses.'''
+
+        app_log.info("Watching Docker events for pool [%s].", self.pool_name)
+        filters = dockworker.label_filters(self.labels)
+        filters.update({
+            'type': 'container',
+            'event': ['die', 'oom', 'destroy'],
+        })
+        yield self.spawner.watch_events(self._on_docker_event, filters=filters)
 
-        app_log.info("Server [%s] at address [%s:%s] has booted! Have at it.",
-                     path, ip, port)
+    def _on_docker_event(self, event):
+        container = self.registry.get(event.get('id'))
+        if container is None or container.state == RELEASING:
+            # Not ours, or already on its way out.
+            return
 
-    def _pooled_ids(self):
-        '''Build a set of container IDs that are currently waiting in the pool.'''
+        status = event.get('status') or event.get('Action')
+        if status == 'oom':
+            app_log.warning("Container [%s] ran out of memory.", container)
+        elif status == 'destroy':
+            app_log.info("Container [%s] was removed outside of the pool.", container)
+            self.registry.remove(container)
+            ioloop.IOLoop.current().spawn_callback(self._proxy_remove, container.path)
+            self._maybe_refill()
+        elif status == 'die' and container.state != DEAD:
+            app_log.warning("Container [%s] died (exit code %s); replacing it.", container,
+                            event.get('Actor', {}).get('Attributes', {}).get('exitCode'))
+            self.registry.transition(container, DEAD)
+            loop = ioloop.IOLoop.current()
+            loop.spawn_callback(self._proxy_remove, container.path)
+            loop.spawn_callback(self._remove_dead, container)
+            self._maybe_refill()
 
-        return set(container.id for container in self.available)
+    @gen.coroutine
+    def reconcile(self):
+        '''Bring the registry in line with what Docker reports.
+
+        Containers that have exited are marked dead for the heartbeat to remove, containers that
+        have disappeared are forgotten, and running containers from this pool that the registry
+        doesn't know about are adopted as in use so that they are culled like any other.'''
+
+        containers = yield self.spawner.list_notebook_servers(self.labels, all=True)
+        creating = set(container.name for container in self.registry.in_state(CREATING))
+
+        seen = {}
+        for info in containers:
+            seen[info['Id']] = info
+            if self.registry.get(info['Id']) is not None:
+                continue
+            name = (info.get('Names') or ['/'])[0].lstrip('/')
+            if name in creating or name in self._preparing_names:
+                # Its create call has not returned yet.
+                continue
+            labels = info.get('Labels') or {}
+            container = PooledContainer(id=info['Id'], path=labels.get(dockworker.PATH_LABEL, name),
+                                        name=name, labels=labels)
+            if info['Status'].startswith('Up'):
+                app_log.info("Adopting unknown running container [%s].", container)
+                container.state = ASSIGNED
+                container.acquired = container.created
+            else:
+                container.state = DEAD
+            self.registry.add(container)
+
+        for container in self.registry:
+            if container.id is None or container.state in (CREATING, RELEASING):
+                continue
+            info = seen.get(container.id)
+            if info is None:
+                app_log.info("Forgetting container [%s], which no longer exists.", container)
+                self.registry.remove(container)
+            elif (container.state not in (DEAD, CREATED) and
+                  not info['Status'].startswith('Up')):
+                app_log.info("Container [%s] has stopped.", container)
+                self.registry.transition(container, DEAD)
+
+        self._maybe_refill()
 
     @gen.coroutine
     def _proxy_remove(self, path):
@@ -389,41 +2180,39 @@ class SpawnPool():
         if(self.static_files is None):
             raise Exception("static_files must be set in order to dump them")
 
-        container = self.available[0]
+        # Any running container will do; they all come from the same image.
+        yield self.serving.wait()
+        container = self.registry.in_state(POOLED, ASSIGNED)[-1]
 
         app_log.info("Extracting static files from container {}".format(container.id))
 
-        tarball = yield self.spawner.copy_files(container.id, self.static_files)
-
-        tar = open(os.path.join(self.static_dump_path, "static.tar"), "wb")
-        tar.write(tarball.data)
-        tar.close()
+        with open(os.path.join(self.static_dump_path, "static.tar"), "wb") as tar:
+            yield self.spawner.copy_files(container.id, self.static_files, tar)
 
         app_log.debug("Static files extracted")
 
 class Diagnosis():
     '''Collect and organize information to self-heal a SpawnPool.
 
-    Measure the current state of Docker and the proxy routes and scan for anomalies so the pool can
-    correct them. This includes zombie containers, containers that are running but not routed in the
-    proxy, proxy routes that exist without a corresponding container, or other strange conditions.'''
+    Measure the current state of the pool's container registry and the proxy routes and scan for
+    anomalies so the pool can correct them. This includes zombie containers, containers that are
+    running but not routed in the proxy, proxy routes that exist without a corresponding container,
+    or other strange conditions. The registry is kept in line with Docker by SpawnPool.reconcile.'''
 
-    def __init__(self, cull_idle, cull_max_age, spawner, name_pattern, proxy_endpoint, proxy_token, started):
-        self.spawner = spawner
-        self.name_pattern = name_pattern
+    def __init__(self, cull_idle, cull_max_age, registry, proxy_endpoint, proxy_token):
+        self.registry = registry
         self.proxy_endpoint = proxy_endpoint
         self.proxy_token = proxy_token
         self.cull_idle = cull_idle
         self.cull_max_age = cull_max_age
-        self.started = started
 
     @gen.coroutine
     def observe(self):
-        '''Collect Ground Truth of what's actually running from Docker and the proxy.'''
+        '''Collect the state of the registry and the routes the proxy actually holds.'''
 
-        results = yield {
-            "docker": self.spawner.list_notebook_servers(self.name_pattern, all=True),
-            "proxy": self._proxy_routes()
+        results = {
+            "containers": [container for container in self.registry if container.id is not None],
+            "proxy": (yield self._proxy_routes())
         }
 
         self.container_ids = set()
@@ -436,13 +2225,15 @@ class Diagnosis():
         self.stale_routes = []
         self.zombie_routes = []
 
-        # Sort Docker results into living and dead containers.
-        for container in results["docker"]:
-            id = container['Id']
+        # Sort the registry into living and dead containers.
+        started_at = {}
+        for container in results["containers"]:
+            id = container.id
             self.container_ids.add(id)
-            if container['Status'].startswith('Up'):
+            started_at[id] = container.acquired
+            if container.state in LIVE_STATES:
                 self.living_container_ids.append(id)
-            else:
+            elif container.state == DEAD:
                 self.stopped_container_ids.append(id)
 
         now = datetime.utcnow()
@@ -459,7 +2250,7 @@ class Diagnosis():
                 if container_id in living_set:
                     try:
                         last_activity = datetime.strptime(last_activity_s, _date_fmt)
-                        started = self.started.get(container_id, None)
+                        started = started_at.get(container_id, None)
                         self.routes.add(result)
                         if started and last_activity < idle_cutoff:
                             app_log.info("Culling %s, idle since %s", path, last_activity)
@@ -479,16 +2270,23 @@ class Diagnosis():
 
     @gen.coroutine
     def _proxy_routes(self):
-        routes = []
-
-        url = "{}/api/routes".format(self.proxy_endpoint)
-        headers = {"Authorization": "token {}".format(self.proxy_token)}
-        req = HTTPRequest(url, method="GET", headers=headers)
-        http_client = AsyncHTTPClient()
-        try:
-            resp = yield http_client.fetch(req)
-            results = json.loads(resp.body.decode('utf8', 'replace'))
-            raise gen.Return(results)
-        except HTTPError as e:
-            app_log.error("Unable to list existing proxy entries: %s", e)
-            raise gen.Return({})
+        routes = yield proxy_routes(self.proxy_endpoint, self.proxy_token)
+        raise gen.Return(routes)
+
+
+@gen.coroutine
+def proxy_routes(proxy_endpoint, proxy_token):
+    '''Fetch the routes the proxy holds, keyed by path. Returns no routes if they can't be
+    listed.'''
+
+    url = "{}/api/routes".format(proxy_endpoint)
+    headers = {"Authorization": "token {}".format(proxy_token)}
+    req = HTTPRequest(url, method="GET", headers=headers)
+    http_client = AsyncHTTPClient()
+    try:
+        resp = yield http_client.fetch(req)
+        results = json.loads(resp.body.decode('utf8', 'replace'))
+        raise gen.Return(results)
+    except HTTPError as e:
+        app_log.error("Unable to list existing proxy entries: %s", e)
+        raise gen.Return({})